@@ -1,8 +1,12 @@
+#!/usr/bin/env python3
 # BJH Utils: Copyright © 2021 Benjamin Holt -- MIT License
 # Utilities mostly meant for command-line use in Xonsh
 
 ###  URL utils  ###
+import functools
+import sys
 import urllib.parse as urls
+from collections import Counter
 
 def urlify(**kwargs):
     "URL-encode keyword arguments as a query string"
@@ -18,16 +22,113 @@ def url2d(url):
     qd = { k: unwrap(v) for k,v in qd.items() }
     pd = pr._asdict()
     pd["query"] = qd
-    
+
     return pd
 
 
 def d2url(d):
-    "Breaks down a URL into a dictionary, including decoding query string"
+    "Builds a URL from a dictionary like url2d makes, encoding the query if it's a dict"
     if type(d.get("query")) is dict:
         d = d.copy()
-        d["query"] = urls.urlencode(d["query"])
+        d["query"] = urls.urlencode(d["query"], doseq=True)  # doseq for url2d's multi-value lists
     parts = urls.ParseResult(**d)
-    return urls.unparse(parts)
+    return urls.urlunparse(parts)
+
+
+TRACKING_PARAMS = frozenset(("fbclid", "gclid", "dclid", "gbraid", "wbraid", "msclkid", "yclid", "igshid", "mc_cid", "mc_eid", "_hsenc", "_hsmi", "mkt_tok"))
+TRACKING_PREFIXES = ("utm_",)
+DEFAULT_PORTS = {"http": "80", "https": "443", "ftp": "21", "ws": "80", "wss": "443"}
+QUERY_SAFE = "/:@,"  # Left unescaped in canonical queries, for readability
+CACHE_SIZE = 16 * 1024  # Hosts and queries memoized by canonical_url; tab dumps repeat both a lot
+
+def canonical_url(url):
+    "Canonical form of a URL for comparing: lowercase scheme and host, no default port, query sorted by name without tracking parameters"
+    url = url.strip()
+    try:
+        scheme, netloc, path, query, fragment = urls.urlsplit(url)
+    except ValueError:
+        return url  # Unparseable (e.g. a bad IPv6 host), so it can only match itself
+    scheme = scheme.lower()
+    netloc = _canonical_netloc(scheme, netloc)
+    if not path and netloc and scheme in DEFAULT_PORTS:
+        path = "/"
+    return urls.urlunsplit((scheme, netloc, path, _canonical_query(query), fragment))
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _canonical_netloc(scheme, netloc):
+    userinfo, at, host = netloc.rpartition("@")
+    host = host.lower().removesuffix(":")
+    port = DEFAULT_PORTS.get(scheme)
+    if port and host.endswith(":" + port):
+        host = host[:-len(port) - 1]
+    return userinfo + at + host
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _canonical_query(query):
+    "Sorted by name, keeping the order of repeated names, re-escaped consistently, tracking parameters dropped; bare names (no =) stay bare"
+    params = []
+    for param in query.split("&"):
+        name, eq, value = param.partition("=")
+        name = urls.unquote_plus(name)
+        if not param or name.lower() in TRACKING_PARAMS or name.lower().startswith(TRACKING_PREFIXES):
+            continue
+        params.append((name, eq, urls.unquote_plus(value)))
+    params.sort(key=lambda param: param[0])  # Stable, since `a=2&a=1` can mean something different from `a=1&a=2`
+    return "&".join(urls.quote_plus(n, safe=QUERY_SAFE) + eq + urls.quote_plus(v, safe=QUERY_SAFE) for n, eq, v in params)
+
+
+def extract_urls(lines):
+    "Yields the URL from each line that's a markdown link, like tabgrab's `- [Title](url)`, or a bare URL; blank lines are skipped"
+    for line in lines:
+        start = line.rfind("](")
+        end = line.rfind(")")
+        if start >= 0 and end > start:
+            yield line[start + 2:end]
+        elif line := line.strip():
+            yield line
+
+
+def dedup_urls(url_iter, counts=None):
+    "Canonicalizes URLs, yielding each one the first time it's seen; if given, counts (e.g. a Counter) is updated with every occurrence"
+    counts = Counter() if counts is None else counts
+    for url in url_iter:
+        url = canonical_url(url)
+        seen = counts[url]
+        counts[url] = seen + 1
+        if not seen:
+            yield url
 
 #####
+
+
+###  Command line  ###
+def main(argv):
+    import argparse
+    import fileinput
+    parser = argparse.ArgumentParser(description="BJH Utils from the command line")
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND", required=True)
+    urls_parser = subparsers.add_parser("urls", help="Canonicalize and deduplicate URLs")
+    urls_parser.description = "Read URLs, bare or as markdown links like tabgrab's, and print each canonical URL the first time it's seen"
+    urls_parser.add_argument("files", nargs="*", metavar="FILE", help="Files to read (default: stdin)")
+    urls_parser.add_argument("--counts", metavar="FILE", help="Write how many times each URL was seen, as count<TAB>URL lines, most first")
+    args = parser.parse_args(argv[1:])
+
+    sys.stdout.reconfigure(errors="surrogateescape")
+    write = sys.stdout.write
+    counts = Counter()
+    with fileinput.input(args.files, encoding="utf-8", errors="surrogateescape") as lines:
+        for url in dedup_urls(extract_urls(lines), counts):
+            write(url + "\n")
+    print(f"{counts.total()} URLs, {len(counts)} unique", file=sys.stderr)
+    if args.counts:
+        with open(args.counts, "w", encoding="utf-8", errors="surrogateescape") as f:
+            for url, count in counts.most_common():
+                f.write(f"{count}\t{url}\n")
+#####
+
+
+if __name__ == "__main__":
+    _xit = main(sys.argv)
+    sys.exit(_xit)
@@ -4,33 +4,938 @@ Dennis File - A file indexing and duplicate finding utility
 """
 
 import argparse
+import contextlib
+import csv
 import hashlib
+import itertools
+import json
+import mmap
 import os
+import queue
+import random
+import socket
 import sqlite3
+import struct
 import sys
+import threading
+import time
 from datetime import datetime
 from pathlib import Path
 
 
+PROGRESS_INTERVAL = 100  # Files per progress update...
+PROGRESS_SECONDS = 0.5  # ...or at least this often while hashing big files
+WRITE_BATCH_SIZE = 10000  # Rows per executemany transaction...
+WRITE_BATCH_SECONDS = 2.0  # ...or commit at least this often while hashing
+RACY_MTIME_SECONDS = 2.0  # Directories changed this recently may change again within the same mtime tick
+SCHEMA_VERSION = 9  # Stored in PRAGMA user_version
+SCAN_PHASES = ('walk', 'stat', 'lookup', 'hash', 'write')  # Timed separately by ScanProgress
+
+# How much of a file's content `hash` covers
+HASH_NONE = 'none'        # Size and mtime only (lazy scan, no collisions yet)
+HASH_PARTIAL = 'partial'  # First and last PARTIAL_HASH_SIZE bytes
+HASH_FULL = 'full'        # Entire file
+PARTIAL_HASH_SIZE = 64 * 1024
+
+# Content hashes; a database records the one it was built with, so hashes never mix
+HASH_ALGORITHMS = {
+    'sha256': hashlib.sha256,
+    'blake2b': lambda: hashlib.blake2b(digest_size=32),  # Same width as SHA-256, usually faster on 64-bit CPUs
+    'blake2s': hashlib.blake2s,
+    'sha1': hashlib.sha1,
+    'md5': hashlib.md5,
+}
+DEFAULT_HASH = 'sha256'
+READ_SIZE = 1024 * 1024  # Bytes per readinto() when not memory-mapping
+
+# Content-defined chunks for `scan --chunks` and dedup-estimate
+CHUNK_MIN_SIZE = 2 * 1024
+CHUNK_MAX_SIZE = 64 * 1024
+CHUNK_SCAN_SIZE = 16 * 1024 * 1024  # Bytes searched for boundaries at a time
+CHUNK_RECORD = struct.Struct('<QI16s')  # offset, size, 128-bit BLAKE2b of the chunk
+CHUNK_BATCH_RECORDS = 4096  # A big file's chunk records go to the writer this many at a time (~112 KiB)
+CHUNK_BATCHES_QUEUED = 16  # Bound on those batches waiting for the writer
+
+# SQL snippets for `files f JOIN dirs d ON d.id = f.dir_id`
+FILE_PATH = f"rtrim(d.path, '{os.sep}') || '{os.sep}' || f.name"
+# Identifies the content a row points at: hardlinks on one volume share one; rows indexed before inodes were tracked count separately
+INODE_KEY = "COALESCE(f.volume_id || ':' || f.dev || ':' || f.ino, 'id:' || f.id)"
+
+# Merged and attached indexes put each host or volume's paths under //name, like a UNC path
+VOLUME_PREFIX = os.sep * 2
+SHARD_ID_SPACING = 1 << 40  # Row id offset between attached shards
+
+
+_read_buffers = threading.local()  # One reusable read buffer per hashing thread
+
+
+def digest_file(file_path, algorithm=DEFAULT_HASH, read_size=READ_SIZE, use_mmap=False):
+    """Hash a whole file with a reused per-thread readinto() buffer, or straight from a memory map"""
+    digest = HASH_ALGORITHMS[algorithm]()
+    with open(file_path, 'rb', buffering=0) as f:
+        if use_mmap and os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                digest.update(m)
+            return digest.digest()
+
+        buf = getattr(_read_buffers, 'buf', None)
+        if buf is None or len(buf) != read_size:
+            buf = _read_buffers.buf = bytearray(read_size)
+        view = memoryview(buf)
+        while n := f.readinto(buf):
+            digest.update(view[:n])
+    return digest.digest()
+
+
+def _chunk_hash_params(seed=0x44656e6e):
+    """2-bit symbol for each byte value, and the 6-symbol window that ends a chunk
+
+    Fixed by the seed, so the same content splits the same way on every machine.
+    """
+    rng = random.Random(seed)
+    return bytes(rng.randrange(4) for _ in range(256)), bytes(rng.randrange(4) for _ in range(6))
+
+
+CHUNK_SYMBOLS, CHUNK_ANCHOR = _chunk_hash_params()
+
+
+def content_chunks(buf):
+    """Yield (offset, size) for content-defined chunks of buf
+
+    A chunk ends where a rolling hash of the last 6 bytes (2 bits shifted in
+    per byte) hits a target value, about once every 4 KiB of random data, so
+    inserting or removing bytes only moves the boundaries near the edit.
+    Instead of updating the hash byte by byte in Python, bytes.translate
+    maps every byte to its 2 bits and bytes.find looks for the target window,
+    both in C.  Chunks are kept between CHUNK_MIN_SIZE and CHUNK_MAX_SIZE.
+    """
+    size = len(buf)
+    window = len(CHUNK_ANCHOR)
+    start = 0
+    for segment in range(0, size, CHUNK_SCAN_SIZE):
+        lower = max(segment - window + 1, 0)  # Windows that straddle the previous segment
+        symbols = buf[lower:segment + CHUNK_SCAN_SIZE].translate(CHUNK_SYMBOLS)
+        i = symbols.find(CHUNK_ANCHOR)
+        while i >= 0:
+            end = lower + i + window
+            while end - start > CHUNK_MAX_SIZE:
+                yield start, CHUNK_MAX_SIZE
+                start += CHUNK_MAX_SIZE
+            if end - start >= CHUNK_MIN_SIZE:
+                yield start, end - start
+                start = end
+            i = symbols.find(CHUNK_ANCHOR, i + 1)
+    while size - start > CHUNK_MAX_SIZE:
+        yield start, CHUNK_MAX_SIZE
+        start += CHUNK_MAX_SIZE
+    if size > start:
+        yield start, size - start
+
+
+def chunk_file(file_path, algorithm=DEFAULT_HASH, spill=None):
+    """Hash a whole file and its content-defined chunks in one pass over a memory map
+
+    Chunks cover the file in order, so the whole-file digest is fed chunk by
+    chunk while each one is still in memory.  Returns (digest, chunks) where
+    chunks packs a CHUNK_RECORD per chunk, about 28 bytes for every 5.5 KiB
+    of the file.  With spill, every CHUNK_BATCH_RECORDS records are passed
+    to spill(chunks) as they're made and only the rest are returned, so
+    memory stays bounded however big the file is.
+    """
+    digest = HASH_ALGORITHMS[algorithm]()
+    chunks = bytearray()
+    batch_bytes = CHUNK_BATCH_RECORDS * CHUNK_RECORD.size
+    with open(file_path, 'rb', buffering=0) as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return digest.digest(), bytes(chunks)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, memoryview(m) as view:
+            for offset, size in content_chunks(m):
+                with view[offset:offset + size] as chunk:
+                    digest.update(chunk)
+                    chunks += CHUNK_RECORD.pack(offset, size, hashlib.blake2b(chunk, digest_size=16).digest())
+                if spill and len(chunks) >= batch_bytes:
+                    spill(bytes(chunks))
+                    chunks.clear()
+    return digest.digest(), bytes(chunks)
+
+
+def bench_hash(algorithms, read_sizes, data_size, file_path=None):
+    """Print hashing throughput in MB/s for each algorithm and read size
+
+    Uses file_path if given, otherwise a temporary file of random data; either
+    way it's read once first so the numbers reflect a warm page cache.
+    """
+    import tempfile  # Slow to import, and only the benchmarks need it
+    temp = None
+    if file_path is None:
+        temp = tempfile.NamedTemporaryFile(prefix='dennisfile-bench-', delete=False)
+        with temp:
+            for _ in range(0, data_size, READ_SIZE):
+                temp.write(os.urandom(READ_SIZE))
+        file_path = temp.name
+
+    try:
+        size = os.path.getsize(file_path)
+        print(f"Hashing {DennisFile.format_size(size)} from {file_path}\n")
+        digest_file(file_path)  # Warm the page cache
+
+        settings = [(f"{n // 1024} KiB", n, False) for n in read_sizes] + [('mmap', READ_SIZE, True)]
+        print(f"{'MB/s':<10}" + "".join(f"{label:>12}" for label, _, _ in settings))
+        for algorithm in algorithms:
+            print(f"{algorithm:<10}", end="", flush=True)
+            for _, read_size, use_mmap in settings:
+                start = time.perf_counter()
+                digest_file(file_path, algorithm, read_size, use_mmap)
+                elapsed = time.perf_counter() - start
+                print(f"{size / elapsed / 1e6:>12.1f}", end="", flush=True)
+            print()
+    finally:
+        if temp:
+            os.unlink(temp.name)
+
+
+# Synthetic trees for bench-scan: directories, nesting depth, files per directory,
+# (min, max) file size, and how many distinct contents the files share (None for all different)
+BENCH_SHAPES = {
+    'tiny': (100, 1, 200, (0, 4 * 1024), None),
+    'huge': (1, 1, 4, (64 * 1024 * 1024, 64 * 1024 * 1024), None),
+    'deep': (400, 40, 5, (0, 16 * 1024), None),
+    'dupes': (50, 2, 40, (4 * 1024, 128 * 1024), 100),
+}
+
+
+def make_bench_tree(root, shape, scale=1.0, seed=0):
+    """Fill root with a reproducible tree of the given BENCH_SHAPES shape; returns (files, bytes)
+
+    scale multiplies the number of directories.  Nested directories form
+    chains `cNNN/d01/d02/...` as deep as the shape's nesting depth.
+    """
+    dir_count, nesting, files_per_dir, (min_size, max_size), distinct = BENCH_SHAPES[shape]
+    rng = random.Random(seed)
+    contents = [rng.randbytes(rng.randint(min_size, max_size)) for _ in range(distinct or 0)]
+    file_count = total_size = 0
+    for i in range(max(1, round(dir_count * scale))):
+        chain, level = divmod(i, nesting)
+        dir_path = os.path.join(root, f"c{chain:03d}", *(f"d{n:02d}" for n in range(1, level + 1)))
+        os.makedirs(dir_path, exist_ok=True)
+        for j in range(files_per_dir):
+            data = rng.choice(contents) if contents else rng.randbytes(rng.randint(min_size, max_size))
+            with open(os.path.join(dir_path, f"f{j:04d}.bin"), 'wb') as f:
+                f.write(data)
+            file_count += 1
+            total_size += len(data)
+    return file_count, total_size
+
+
+def bench_scan(shapes, scale=1.0, jobs=1, work_dir=None):
+    """Time scan, unchanged rescan, quick rescan and duplicates on synthetic trees
+
+    Prints a table and returns one dict per shape, with the full metrics of
+    each scan.  Trees and databases are generated under work_dir (a
+    temporary directory by default, e.g. pass a path on the disk to size)
+    and removed afterwards.  Files are freshly written, so the first scan
+    mostly reads from the page cache.
+    """
+    import tempfile
+    results = []
+    print(f"{'shape':<8}{'files':>9}{'size':>12}{'scan':>9}{'rescan':>9}{'quick':>9}{'dupes':>9}{'MB/s':>9}")
+    for shape in shapes:
+        with tempfile.TemporaryDirectory(prefix='dennisfile-bench-', dir=work_dir) as temp:
+            root = os.path.join(temp, shape)
+            file_count, total_size = make_bench_tree(root, shape, scale)
+            df = DennisFile(os.path.join(temp, 'bench.db'))
+            try:
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    scan = df.scan_directory(root, jobs=jobs)
+                    rescan = df.scan_directory(root, jobs=jobs)
+                    quick = df.scan_directory(root, jobs=jobs, quick=True)
+                    start = time.perf_counter()
+                    df.find_duplicates(out=devnull)
+                    duplicates = time.perf_counter() - start
+            finally:
+                df.close()
+        results.append({
+            'shape': shape, 'files': file_count, 'bytes': total_size, 'jobs': jobs,
+            'scan': scan, 'rescan': rescan, 'quick': quick, 'duplicates': round(duplicates, 6),
+        })
+        print(f"{shape:<8}{file_count:>9,}{DennisFile.format_size(total_size):>12}"
+              f"{scan['elapsed']:>8.2f}s{rescan['elapsed']:>8.2f}s{quick['elapsed']:>8.2f}s{duplicates:>8.2f}s"
+              f"{scan['mb_per_second']:>9.1f}", flush=True)
+    return results
+
+
+def connect(db_path, timeout=60):
+    """Open an index database with the pragmas every connection should use
+
+    URI filenames are allowed so shards can be attached read-only.
+    """
+    conn = sqlite3.connect(db_path, timeout=timeout, uri=True)
+    conn.execute("PRAGMA journal_mode = WAL")  # Readers and the scan writer don't block each other
+    conn.execute("PRAGMA synchronous = NORMAL")  # Safe with WAL; skips an fsync per commit
+    conn.execute("PRAGMA cache_size = -65536")  # 64 MiB
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA mmap_size = 268435456")  # 256 MiB
+    return conn
+
+
+def shard_uri(db_path):
+    """SQLite URI that opens an index read-only, so merge and --attach never write to their inputs"""
+    return Path(db_path).resolve().as_uri() + "?mode=ro"
+
+
+def read_shard(shard_path):
+    """(volume, hash_algorithm, merged) of a shard index, read without changing it
+
+    Opening a shard as a DennisFile would migrate it and, for one that was
+    never named, stamp it with this host's name, so older shards are refused
+    instead; they need to be opened once where they were scanned.
+    """
+    if not os.path.exists(shard_path):
+        raise ValueError(f"No such database: {shard_path}")
+    try:
+        conn = sqlite3.connect(shard_uri(shard_path), uri=True)
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < SCHEMA_VERSION:
+                raise ValueError(f"{shard_path} is an older index (schema {version}); upgrade it first by opening it "
+                                 f"where it was scanned, e.g. `dennisfile.py --db {shard_path} stats`")
+            if version > SCHEMA_VERSION:
+                raise ValueError(f"{shard_path} is from a newer dennisfile (schema {version})")
+            meta = dict(conn.execute("SELECT key, value FROM meta"))
+            row = conn.execute("SELECT name FROM volumes WHERE id = 1").fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        raise ValueError(f"Can't read {shard_path}: {e}")
+    if not row and 'merged' not in meta:
+        raise ValueError(f"{shard_path} has no volume name; give it one with `scan --volume`")
+    return row and row[0], meta.get('hash_algorithm', DEFAULT_HASH), 'merged' in meta
+
+
+def dir_depth(dir_path):
+    """Number of components below the filesystem root"""
+    return len(Path(dir_path).parts) - 1
+
+
+def dir_range(dir_path):
+    """(lower, upper) bounds such that lower <= path < upper for every path below dir_path"""
+    prefix = os.path.join(dir_path, '')
+    return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+
+
+def ensure_dirs(conn, dir_paths, dir_ids):
+    """Create any missing `dirs` rows, adding their ids to the dir_ids path -> id cache"""
+    missing = {dir_path for dir_path in dir_paths if dir_path not in dir_ids}
+    if missing:
+        conn.executemany("""
+            INSERT INTO dirs (path, depth, file_count, total_size, tree_count, tree_size)
+            VALUES (?, ?, 0, 0, 0, 0)
+            ON CONFLICT(path) DO NOTHING
+        """, [(dir_path, dir_depth(dir_path)) for dir_path in missing])
+        for dir_path in missing:
+            dir_ids[dir_path] = conn.execute("SELECT id FROM dirs WHERE path = ?", (dir_path,)).fetchone()[0]
+    return dir_ids
+
+
+def sql_quote(value):
+    """A string as an SQL literal, for views (which can't take parameters)"""
+    return "'" + value.replace("'", "''") + "'"
+
+
+def volume_selects(schema, volume, volume_id, offset, keep_file_ids=True):
+    """SELECTs that present one shard's dirs, files and scans under //volume
+
+    Directory, scan (and with keep_file_ids, file) ids are shifted by offset
+    so several shards can share one id space; the shard's filesystem root
+    becomes the //volume directory itself.
+    """
+    prefix = sql_quote(VOLUME_PREFIX + volume)
+    dirs = f"""
+        SELECT id + {offset} AS id,
+               CASE path WHEN {sql_quote(os.sep)} THEN {prefix} ELSE {prefix} || path END AS path,
+               depth + 1 AS depth, file_count, total_size, tree_count, tree_size, largest_size, largest_name,
+               NULL AS mtime, NULL AS subdirs
+        FROM {schema}.dirs
+    """
+    files = f"""
+        SELECT {f'id + {offset}' if keep_file_ids else 'NULL'} AS id, dir_id + {offset} AS dir_id, name, size,
+               hash, hash_state, mtime, scan_id + {offset} AS scan_id, dev, ino, {volume_id} AS volume_id
+        FROM {schema}.files
+    """
+    scans = f"""
+        SELECT id + {offset} AS id, {prefix} || root AS root, started, finished
+        FROM {schema}.scans
+    """
+    return dirs, files, scans
+
+
+def update_dir_rollup(conn, changes):
+    """Apply (path, new_size, old_size) file changes to the `dirs` aggregates
+
+    A new_size or old_size of None means the file was removed or added.  Each
+    directory keeps totals for the files directly in it and for its whole
+    subtree, plus its largest direct file, so usage queries never touch `files`.
+    Returns the number of directories deleted because nothing is left in them.
+    """
+    direct = {}  # dir -> [file count delta, size delta]
+    largest = {}  # dir -> (size, name) of its biggest added or grown file
+    shrunk = {}  # dir -> names that shrank or went away, in case one was its largest
+    for path, new_size, old_size in changes:
+        dir_path, name = os.path.split(path)
+        delta = direct.setdefault(dir_path, [0, 0])
+        delta[0] += (new_size is not None) - (old_size is not None)
+        delta[1] += (new_size or 0) - (old_size or 0)
+        if new_size is not None and new_size > largest.get(dir_path, (-1,))[0]:
+            largest[dir_path] = (new_size, name)
+        if old_size is not None and (new_size is None or new_size < old_size):
+            shrunk.setdefault(dir_path, set()).add(name)
+
+    tree = {}
+    for dir_path, (count, size) in direct.items():
+        while True:
+            totals = tree.setdefault(dir_path, [0, 0])
+            totals[0] += count
+            totals[1] += size
+            parent = os.path.dirname(dir_path)
+            if parent == dir_path:
+                break
+            dir_path = parent
+
+    conn.executemany("""
+        INSERT INTO dirs (path, depth, file_count, total_size, tree_count, tree_size, largest_size, largest_name)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(path) DO UPDATE SET
+            file_count = file_count + excluded.file_count,
+            total_size = total_size + excluded.total_size,
+            tree_count = tree_count + excluded.tree_count,
+            tree_size = tree_size + excluded.tree_size,
+            largest_size = CASE WHEN excluded.largest_size > COALESCE(largest_size, -1)
+                THEN excluded.largest_size ELSE largest_size END,
+            largest_name = CASE WHEN excluded.largest_size > COALESCE(largest_size, -1)
+                THEN excluded.largest_name ELSE largest_name END
+    """, [
+        (dir_path, dir_depth(dir_path), *direct.get(dir_path, (0, 0)), *totals, *largest.get(dir_path, (None, None)))
+        for dir_path, totals in tree.items()
+    ])
+
+    # A shrunk or removed largest file means looking for the new largest
+    for dir_path, names in shrunk.items():
+        row = conn.execute("SELECT id, largest_name FROM dirs WHERE path = ?", (dir_path,)).fetchone()
+        if row and row[1] in names:
+            largest_row = conn.execute(
+                "SELECT size, name FROM files WHERE dir_id = ? ORDER BY size DESC LIMIT 1", (row[0],)
+            ).fetchone() or (None, None)
+            conn.execute("UPDATE dirs SET largest_size = ?, largest_name = ? WHERE id = ?", (*largest_row, row[0]))
+
+    return conn.execute("DELETE FROM dirs WHERE tree_count <= 0").rowcount
+
+
+class PhaseTimer:
+    """One timed stretch of a ScanProgress phase; a plain class costs half what a generator context manager does"""
+    __slots__ = ('progress', 'phase', 'start')
+
+    def __init__(self, progress, phase):
+        self.progress = progress
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.progress.add_time(self.phase, time.perf_counter() - self.start)
+
+
+class ScanProgress:
+    """Thread-safe scan counters and phase timings, with a self-overwriting progress line
+
+    Phases are SCAN_PHASES, plus `resolve` for the collision pass after a
+    lazy scan.  Each one adds up the time spent in it on every thread, so
+    with parallel hashing `hash` can exceed the elapsed time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.added = 0
+        self.updated = 0
+        self.hashed = 0
+        self.hashed_bytes = 0
+        self.phases = dict.fromkeys(SCAN_PHASES, 0.0)
+        self.started = self.reported = time.perf_counter()
+
+    def advance(self, added=0, updated=0, count=1):
+        with self.lock:
+            before = self.processed
+            self.processed += count
+            self.added += added
+            self.updated += updated
+            if self.processed // PROGRESS_INTERVAL != before // PROGRESS_INTERVAL:
+                self._report()
+
+    def add_hashed(self, size):
+        """Count a file whose content was read"""
+        with self.lock:
+            self.hashed += 1
+            self.hashed_bytes += size
+            if time.perf_counter() - self.reported >= PROGRESS_SECONDS:
+                self._report()
+
+    def _report(self):
+        self.reported = time.perf_counter()
+        elapsed = self.reported - self.started
+        print(f"Processed {self.processed:,} files, {self.processed / elapsed:,.0f} files/s, "
+              f"{self.hashed_bytes / elapsed / 1e6:,.1f} MB/s...", end='\r')
+
+    def add_time(self, phase, seconds):
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def timed(self, phase):
+        """Context manager that adds the time spent in it to phase
+
+        Per-file loops on the main thread add up their own perf_counter()
+        differences and call add_time instead, which costs much less.
+        """
+        return PhaseTimer(self, phase)
+
+    def timed_iter(self, phase, iterable):
+        """Iterate, counting the time spent producing each item toward phase"""
+        iterator = iter(iterable)
+        while True:
+            with self.timed(phase):
+                item = next(iterator, self)  # Nothing the iterator yields can be this object
+            if item is self:
+                return
+            yield item
+
+    def metrics(self):
+        """Counters, throughput and phase seconds, as plain data for --metrics-json"""
+        with self.lock:
+            elapsed = time.perf_counter() - self.started
+            return {
+                'elapsed': round(elapsed, 6),
+                'files': self.processed,
+                'added': self.added,
+                'updated': self.updated,
+                'hashed_files': self.hashed,
+                'hashed_bytes': self.hashed_bytes,
+                'files_per_second': round(self.processed / elapsed, 1),
+                'mb_per_second': round(self.hashed_bytes / elapsed / 1e6, 1),
+                'phases': {phase: round(seconds, 6) for phase, seconds in self.phases.items()},
+            }
+
+
+class TreeWalk:
+    """Walk a tree with scandir, skipping directories that haven't changed since the last scan
+
+    Iterating yields (dir_path, files, unreadable, state) for each listed
+    directory, where files are DirEntry objects (which cache their stat
+    results), unreadable names entries that couldn't be checked, and state
+    is (mtime, or None if too recent to trust, subdirs) to remember it by.
+
+    A directory whose mtime matches `previous` (path -> (mtime, subdirs, ...)
+    from the last scan) isn't listed; it yields (dir_path, None, None, state)
+    and its remembered subdirectories are walked instead.  Adding, removing
+    or renaming an entry changes a directory's mtime, but editing a file in
+    place doesn't.  Directories in `done` (path -> (mtime, subdirs), from an
+    interrupted scan) aren't even looked at, and yield a state of None.
+    """
+
+    def __init__(self, root_path, previous=None, done=None):
+        self.root_path = str(root_path)
+        self.previous = previous or {}
+        self.done = done or {}
+        self.failed = []  # Directories that couldn't be listed, so their files are kept as they are
+
+    def __iter__(self):
+        stack = [self.root_path]
+        while stack:
+            dir_path = stack.pop()
+            if dir_path in self.done:
+                stack.extend(os.path.join(dir_path, name) for name in self.done[dir_path][1])
+                yield dir_path, None, None, None
+                continue
+
+            files, subdirs, unreadable = [], [], set()
+            try:
+                checked = time.time()
+                mtime = os.stat(dir_path).st_mtime
+                state = self.previous.get(dir_path)
+                if state and state[0] == mtime:
+                    files = None
+                    subdirs = state[1]
+                else:
+                    with os.scandir(dir_path) as entries:
+                        for entry in entries:
+                            try:
+                                # Like rglob, don't descend into symlinked directories but do index symlinked files
+                                if entry.is_dir(follow_symlinks=False):
+                                    subdirs.append(entry.name)
+                                elif entry.is_file():
+                                    files.append(entry)
+                            except OSError as e:
+                                print(f"\nWarning: Could not process {entry.path}: {e}", file=sys.stderr)
+                                unreadable.add(entry.name)
+            except FileNotFoundError:
+                continue  # Removed since its parent was listed
+            except OSError as e:
+                print(f"\nWarning: Could not list {dir_path}: {e}", file=sys.stderr)
+                self.failed.append(dir_path)
+                continue
+
+            stack.extend(os.path.join(dir_path, name) for name in subdirs)
+            if files is None:
+                yield dir_path, None, None, (mtime, subdirs)
+                continue
+            yield dir_path, files, unreadable, (mtime if mtime < checked - RACY_MTIME_SECONDS else None, subdirs)
+
+    def is_failed(self, dir_path):
+        """Whether dir_path is in or under a directory that couldn't be listed"""
+        return any(dir_path == failed or dir_path.startswith(failed.rstrip(os.sep) + os.sep) for failed in self.failed)
+
+
+class DirTracker:
+    """Counts each listed directory's files until every one is settled, i.e. written or given up on
+
+    on_done(dir_path, mtime, subdirs) runs once a directory is listed and all
+    its files are settled, from whichever thread settles the last one, so a
+    directory is checkpointed only after the rows that came from it.
+    """
+
+    def __init__(self, on_done):
+        self.on_done = on_done
+        self.lock = threading.Lock()
+        self.pending = {}  # dir -> [unsettled files, plus one while still listing, mtime, subdirs]
+
+    def open(self, dir_path, mtime, subdirs):
+        with self.lock:
+            self.pending[dir_path] = [1, mtime, subdirs]
+
+    def add(self, file_path):
+        with self.lock:
+            self.pending[os.path.dirname(file_path)][0] += 1
+
+    def settle(self, file_path):
+        self._release(os.path.dirname(file_path))
+
+    def close(self, dir_path):
+        """The walk is done listing dir_path"""
+        self._release(dir_path)
+
+    def _release(self, dir_path):
+        with self.lock:
+            state = self.pending[dir_path]
+            state[0] -= 1
+            if state[0]:
+                return
+            del self.pending[dir_path]
+        self.on_done(dir_path, *state[1:])
+
+
+# Provisional `chunks.file_id`s for big files whose chunks are written before their row exists
+_spill_ids = itertools.count(-1, -1)
+
+
+class RowBatch:
+    """Collects (path, size, hash, hash_state, mtime, dev, ino) rows and upserts them with executemany
+
+    Finished directories are recorded in `scan_dirs` in the same
+    transactions, as the checkpoint `scan --resume` continues from.  Rows
+    added with chunks replace the file's `chunks`; changed files added
+    without them drop any chunks they had, which no longer match.
+
+    chunks is (spill_id, records): a big file's earlier records arrive
+    through add_spilled while it's still being hashed, and are written
+    under its negative spill_id until its row moves them over.
+
+    Each flush is one transaction, so an interrupted scan only ever leaves
+    complete rows behind; progress counts rows once they are committed.
+    """
+
+    def __init__(self, conn, scan_id, progress):
+        self.conn = conn
+        self.scan_id = scan_id
+        self.progress = progress
+        self.rows = []
+        self.chunked = []  # (path, (spill_id, packed CHUNK_RECORDs))
+        self.spilled = []  # (spill_id, packed CHUNK_RECORDs) of files still being hashed
+        self.spilled_count = 0
+        self.spill_owners = {}  # spill_id -> id of the file its chunks were moved to, for hardlinks
+        self.done_dirs = []
+        self.last_flush = time.monotonic()
+        self.dir_ids = {}
+        self.sizes = set()  # Every size written, for resolve_collisions
+        self.has_chunks = conn.execute("SELECT 1 FROM chunks LIMIT 1").fetchone() is not None
+
+    def add(self, row, old_size, chunks=None):
+        self.rows.append((row, old_size))
+        if chunks is not None:
+            self.chunked.append((row[0], chunks))
+        self.maybe_flush()
+
+    def add_dir(self, dir_path, mtime, subdirs):
+        self.done_dirs.append((self.scan_id, dir_path, mtime, os.sep.join(subdirs)))
+        self.maybe_flush()
+
+    def add_spilled(self, spill_id, records):
+        self.spilled.append((spill_id, records))
+        self.spilled_count += len(records) // CHUNK_RECORD.size
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if (len(self.rows) + len(self.done_dirs) + self.spilled_count >= WRITE_BATCH_SIZE
+                or time.monotonic() - self.last_flush >= WRITE_BATCH_SECONDS):
+            self.flush()
+
+    def flush(self):
+        rows, self.rows = self.rows, []
+        chunked, self.chunked = self.chunked, []
+        done_dirs, self.done_dirs = self.done_dirs, []
+        spilled, self.spilled = self.spilled, []
+        self.spilled_count = 0
+        self.last_flush = time.monotonic()
+        if not rows and not done_dirs and not spilled:
+            return
+        with self.progress.timed('write'), self.conn:
+            # First, as rows in this batch may be the files they belong to
+            for spill_id, records in spilled:
+                self.conn.executemany(
+                    "INSERT INTO chunks (file_id, offset, size, hash) VALUES (?, ?, ?, ?)",
+                    ((spill_id, *record) for record in CHUNK_RECORD.iter_unpack(records)),
+                )
+                self.has_chunks = True
+            if rows:
+                split = [os.path.split(row[0]) for row, _ in rows]
+                dir_ids = ensure_dirs(self.conn, (dir_path for dir_path, _ in split), self.dir_ids)
+                self.conn.executemany("""
+                    INSERT INTO files (dir_id, name, size, hash, hash_state, mtime, dev, ino, scan_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(dir_id, name) DO UPDATE
+                    SET size = excluded.size, hash = excluded.hash, hash_state = excluded.hash_state,
+                        mtime = excluded.mtime, dev = excluded.dev, ino = excluded.ino,
+                        scan_id = excluded.scan_id
+                """, [
+                    (dir_ids[dir_path], name, *row[1:], self.scan_id)
+                    for (dir_path, name), (row, _) in zip(split, rows)
+                ])
+                if update_dir_rollup(self.conn, [(row[0], row[1], old_size) for row, old_size in rows]):
+                    self.dir_ids.clear()  # Emptied directories are gone
+                if self.has_chunks:
+                    chunked_paths = {path for path, _ in chunked}
+                    self.conn.executemany("""
+                        DELETE FROM chunks WHERE file_id = (
+                            SELECT f.id FROM files f JOIN dirs d ON d.id = f.dir_id WHERE d.path = ? AND f.name = ?
+                        )
+                    """, [
+                        split_path for split_path, (row, old_size) in zip(split, rows)
+                        if old_size is not None and row[0] not in chunked_paths
+                    ])
+                for path, chunks in chunked:
+                    self.write_chunks(path, chunks)
+            # After the rows, which were all queued before their directories finished
+            self.conn.executemany("""
+                INSERT OR REPLACE INTO scan_dirs (scan_id, path, mtime, subdirs) VALUES (?, ?, ?, ?)
+            """, done_dirs)
+        self.sizes.update(row[1] for row, _ in rows)
+        for _, old_size in rows:
+            self.progress.advance(added=old_size is None, updated=old_size is not None)
+
+    def write_chunks(self, path, chunks):
+        spill_id, records = chunks
+        file_id = self.conn.execute(
+            "SELECT f.id FROM files f JOIN dirs d ON d.id = f.dir_id WHERE d.path = ? AND f.name = ?",
+            os.path.split(path),
+        ).fetchone()[0]
+        self.conn.execute("DELETE FROM chunks WHERE file_id = ?", (file_id,))
+        if spill_id in self.spill_owners:
+            # Another path to a big hardlinked file, whose chunks are all written already
+            self.conn.execute("""
+                INSERT INTO chunks (file_id, offset, size, hash) SELECT ?, offset, size, hash FROM chunks WHERE file_id = ?
+            """, (file_id, self.spill_owners[spill_id]))
+            return
+        if spill_id is not None:
+            self.conn.execute("UPDATE chunks SET file_id = ? WHERE file_id = ?", (file_id, spill_id))
+            self.spill_owners[spill_id] = file_id
+        self.conn.executemany(
+            "INSERT INTO chunks (file_id, offset, size, hash) VALUES (?, ?, ?, ?)",
+            ((file_id, *record) for record in CHUNK_RECORD.iter_unpack(records)),
+        )
+        self.has_chunks = True
+
+
+class ScanWriter(threading.Thread):
+    """Single writer thread that feeds hashed rows into a RowBatch
+
+    Owns its own connection so hashing workers never touch SQLite.
+    """
+
+    def __init__(self, db_path, scan_id, progress):
+        super().__init__(name="dennisfile-writer", daemon=True)
+        self.db_path = db_path
+        self.scan_id = scan_id
+        self.progress = progress
+        self.queue = queue.Queue(maxsize=WRITE_BATCH_SIZE)
+        self.spill_slots = threading.BoundedSemaphore(CHUNK_BATCHES_QUEUED)  # Items are small, except these
+        self.error = None
+        self.sizes = set()
+
+    def put(self, row, old_size, chunks=None):
+        self.queue.put((RowBatch.add, (row, old_size, chunks)))
+
+    def put_spilled(self, spill_id, records):
+        self.spill_slots.acquire()
+        self.queue.put((RowBatch.add_spilled, (spill_id, records)))
+
+    def put_dir(self, dir_path, mtime, subdirs):
+        self.queue.put((RowBatch.add_dir, (dir_path, mtime, subdirs)))
+
+    def close(self):
+        """Flush everything queued so far and wait for the final commit"""
+        self.queue.put(None)
+        self.join()
+        if self.error:
+            raise self.error
+
+    def run(self):
+        conn = connect(self.db_path)
+        batch = RowBatch(conn, self.scan_id, self.progress)
+        self.sizes = batch.sizes
+        try:
+            while (item := self.queue.get()) is not None:
+                method, args = item
+                if method is RowBatch.add_spilled:
+                    self.spill_slots.release()  # The batch bounds what it holds itself
+                method(batch, *args)
+            batch.flush()
+        except Exception as e:
+            self.error = e
+            # Keep draining so producers never block on a dead writer
+            while (item := self.queue.get()) is not None:
+                if item[0] is RowBatch.add_spilled:
+                    self.spill_slots.release()
+        finally:
+            conn.close()
+
+
 class DennisFile:
-    def __init__(self, db_path="dennisfile.db"):
+    def __init__(self, db_path="dennisfile.db", hash_algorithm=None, read_size=READ_SIZE, use_mmap=False, volume=None,
+                 chunks=False):
         self.db_path = db_path
         self.conn = None
+        self.read_size = read_size
+        self.use_mmap = use_mmap
+        self.chunks = chunks  # Also index content-defined chunks while hashing
         self.init_database()
+        self.hash_algorithm = self.init_hash_algorithm(hash_algorithm)
+        self.volume = self.init_volume(volume)
 
     def init_database(self):
         """Initialize the SQLite database with required schema"""
-        self.conn = sqlite3.connect(self.db_path)
+        self.conn = connect(self.db_path)
+        cursor = self.conn.cursor()
+
+        cursor.execute("PRAGMA user_version")
+        version = cursor.fetchone()[0]
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'files'")
+        if cursor.fetchone():
+            if version < 1:
+                self.migrate_v0_to_v1()
+            if version < 2:
+                self.migrate_v1_to_v2()
+            if version < 3:
+                self.migrate_v2_to_v3()
+            if version < 5:
+                self.migrate_v3_to_v5()
+            if version < 6:
+                self.migrate_v5_to_v6()
+            if version < 7:
+                self.migrate_v6_to_v7()
+            if version < 8:
+                self.migrate_v7_to_v8()
+            if version < 9:
+                self.migrate_v8_to_v9()
+
+        self.create_tables()
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.conn.commit()
+
+    def create_tables(self):
+        """Create the current schema's tables and indexes if they don't exist"""
         cursor = self.conn.cursor()
 
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS dirs (
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL UNIQUE,
+                depth INTEGER NOT NULL,
+                file_count INTEGER NOT NULL,
+                total_size INTEGER NOT NULL,
+                tree_count INTEGER NOT NULL,
+                tree_size INTEGER NOT NULL,
+                largest_size INTEGER,
+                largest_name TEXT,
+                mtime REAL,
+                subdirs TEXT
+            )
+        """)
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS scans (
+                id INTEGER PRIMARY KEY,
+                root TEXT,
+                started TEXT NOT NULL,
+                finished TEXT
+            )
+        """)
+
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS files (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                path TEXT NOT NULL UNIQUE,
+                dir_id INTEGER NOT NULL REFERENCES dirs(id),
+                name TEXT NOT NULL,
                 size INTEGER NOT NULL,
-                hash TEXT NOT NULL,
+                hash BLOB,
+                hash_state TEXT NOT NULL DEFAULT 'full',
                 mtime REAL NOT NULL,
-                scan_time TEXT NOT NULL
+                scan_id INTEGER REFERENCES scans(id),
+                dev INTEGER,
+                ino INTEGER,
+                volume_id INTEGER NOT NULL DEFAULT 1 REFERENCES volumes(id),
+                UNIQUE (dir_id, name)
+            )
+        """)
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS scan_dirs (
+                scan_id INTEGER NOT NULL REFERENCES scans(id),
+                path TEXT NOT NULL,
+                mtime REAL,
+                subdirs TEXT,
+                PRIMARY KEY (scan_id, path)
+            ) WITHOUT ROWID
+        """)
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS chunks (
+                file_id INTEGER NOT NULL REFERENCES files(id),
+                offset INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                hash BLOB NOT NULL,
+                PRIMARY KEY (file_id, offset)
+            ) WITHOUT ROWID
+        """)
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS volumes (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE
+            )
+        """)
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
             )
         """)
 
@@ -42,136 +947,1069 @@ class DennisFile:
             CREATE INDEX IF NOT EXISTS idx_size ON files(size)
         """)
 
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_inode ON files(dev, ino)
+        """)
+
+    def migrate_v0_to_v1(self):
+        """Make `hash` nullable and add `hash_state` for lazy scans; existing rows are fully hashed"""
+        self.conn.executescript("""
+            BEGIN;
+            CREATE TABLE files_v1 (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                path TEXT NOT NULL UNIQUE,
+                size INTEGER NOT NULL,
+                hash TEXT,
+                hash_state TEXT NOT NULL DEFAULT 'full',
+                mtime REAL NOT NULL,
+                scan_time TEXT NOT NULL
+            );
+            INSERT INTO files_v1 (id, path, size, hash, hash_state, mtime, scan_time)
+                SELECT id, path, size, hash, 'full', mtime, scan_time FROM files;
+            DROP TABLE files;
+            ALTER TABLE files_v1 RENAME TO files;
+            PRAGMA user_version = 1;
+            COMMIT;
+        """)
+
+    def migrate_v1_to_v2(self):
+        """Add device and inode numbers; existing rows get them on their next scan"""
+        self.conn.executescript("""
+            BEGIN;
+            ALTER TABLE files ADD COLUMN dev INTEGER;
+            ALTER TABLE files ADD COLUMN ino INTEGER;
+            PRAGMA user_version = 2;
+            COMMIT;
+        """)
+
+    def migrate_v2_to_v3(self):
+        """Add the meta table; everything indexed so far was hashed with SHA-256"""
+        self.conn.executescript("""
+            BEGIN;
+            CREATE TABLE meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            INSERT INTO meta (key, value) VALUES ('hash_algorithm', 'sha256');
+            PRAGMA user_version = 3;
+            COMMIT;
+        """)
+
+    def migrate_v3_to_v5(self):
+        """Compact layout: files reference a directory row and a scan row, and hashes are BLOBs
+
+        Rebuilds `files` and `dirs` in one transaction, then vacuums to give
+        back the space the full paths and hex hashes took up.  Version 4 only
+        added the first `dirs` table, which this replaces, so a v3 index
+        skips it.
+        """
+        print(f"Migrating {self.db_path} to the compact schema...", file=sys.stderr)
+        conn = self.conn
+        conn.execute("BEGIN")
+        try:
+            conn.execute("ALTER TABLE files RENAME TO files_v4")
+            conn.execute("DROP TABLE IF EXISTS dirs")
+            for index in ('idx_hash', 'idx_size', 'idx_inode'):
+                conn.execute(f"DROP INDEX IF EXISTS {index}")
+            self.create_tables()
+
+            conn.execute("INSERT INTO scans (started) SELECT DISTINCT scan_time FROM files_v4 ORDER BY scan_time")
+            scan_ids = {started: scan_id for scan_id, started in conn.execute("SELECT id, started FROM scans")}
+
+            dir_ids = {}
+            cursor = conn.execute("""
+                SELECT id, path, size, hash, hash_state, mtime, scan_time, dev, ino FROM files_v4
+            """)
+            while rows := cursor.fetchmany(WRITE_BATCH_SIZE):
+                split = [os.path.split(row[1]) for row in rows]
+                ensure_dirs(conn, (dir_path for dir_path, _ in split), dir_ids)
+                conn.executemany("""
+                    INSERT INTO files (id, dir_id, name, size, hash, hash_state, mtime, scan_id, dev, ino)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, [
+                    (row_id, dir_ids[dir_path], name, size, file_hash and bytes.fromhex(file_hash),
+                     hash_state, mtime, scan_ids[scan_time], dev, ino)
+                    for (dir_path, name), (row_id, _, size, file_hash, hash_state, mtime, scan_time, dev, ino)
+                    in zip(split, rows)
+                ])
+            update_dir_rollup(conn, ((path, size, None) for path, size in conn.execute("SELECT path, size FROM files_v4")))
+
+            conn.execute("DROP TABLE files_v4")
+            conn.execute("PRAGMA user_version = 5")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.execute("VACUUM")
+
+    def migrate_v5_to_v6(self):
+        """Remember each directory's mtime and subdirectories; every directory is listed on its next scan"""
+        # migrate_v3_to_v5 creates `dirs` with the current columns
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(dirs)")}
+        with self.conn:
+            if 'mtime' not in columns:
+                self.conn.execute("ALTER TABLE dirs ADD COLUMN mtime REAL")
+            if 'subdirs' not in columns:
+                self.conn.execute("ALTER TABLE dirs ADD COLUMN subdirs TEXT")
+            self.conn.execute("PRAGMA user_version = 6")
+
+    def migrate_v6_to_v7(self):
+        """Tag files with their host or volume; everything so far is on this index's one volume"""
+        # migrate_v3_to_v5 creates `files` with the current columns
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(files)")}
+        with self.conn:
+            if 'volume_id' not in columns:
+                self.conn.execute("ALTER TABLE files ADD COLUMN volume_id INTEGER NOT NULL DEFAULT 1 REFERENCES volumes(id)")
+            self.conn.execute("PRAGMA user_version = 7")
+
+    def migrate_v7_to_v8(self):
+        """Add `scan_dirs`, the directories each scan has finished, for --resume"""
+        # migrate_v3_to_v5 creates every current table, so this one may exist already
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS scan_dirs (
+                    scan_id INTEGER NOT NULL REFERENCES scans(id),
+                    path TEXT NOT NULL,
+                    mtime REAL,
+                    subdirs TEXT,
+                    PRIMARY KEY (scan_id, path)
+                ) WITHOUT ROWID
+            """)
+            self.conn.execute("PRAGMA user_version = 8")
+
+    def migrate_v8_to_v9(self):
+        """Add `chunks` for scan --chunks; files indexed so far have none until they're rehashed"""
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS chunks (
+                    file_id INTEGER NOT NULL REFERENCES files(id),
+                    offset INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    hash BLOB NOT NULL,
+                    PRIMARY KEY (file_id, offset)
+                ) WITHOUT ROWID
+            """)
+            self.conn.execute("PRAGMA user_version = 9")
+
+    def init_hash_algorithm(self, requested=None):
+        """Return the database's hash algorithm, recording the requested one if nothing is hashed yet"""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT value FROM meta WHERE key = 'hash_algorithm'")
+        row = cursor.fetchone()
+        recorded = row[0] if row else None
+        if requested is None or requested == recorded:
+            requested = recorded or DEFAULT_HASH
+        elif recorded:
+            cursor.execute("SELECT 1 FROM files WHERE hash IS NOT NULL LIMIT 1")
+            if cursor.fetchone():
+                raise ValueError(f"{self.db_path} is indexed with {recorded}, not {requested}; use a separate database")
+        if requested not in HASH_ALGORITHMS:
+            raise ValueError(f"Unknown hash algorithm: {requested}")
+        cursor.execute(
+            "INSERT INTO meta (key, value) VALUES ('hash_algorithm', ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (requested,),
+        )
         self.conn.commit()
+        return requested
+
+    def init_volume(self, requested=None):
+        """Return the name this index's files go by in merged indexes, recording the requested one
+
+        Defaults to the host name.  A merged index keeps its shards' names instead.
+        """
+        row = self.conn.execute("SELECT name FROM volumes WHERE id = 1").fetchone()
+        if row and (requested is None or requested == row[0]):
+            return row[0]
+        if requested and self.merged:
+            raise ValueError(f"{self.db_path} is a merged index; name its shards instead")
+        name = requested or socket.gethostname()
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO volumes (id, name) VALUES (1, ?) ON CONFLICT(id) DO UPDATE SET name = excluded.name",
+                (name,),
+            )
+        return name
+
+    @property
+    def merged(self):
+        """Whether this index was built by `merge` from other indexes"""
+        return self.conn.execute("SELECT 1 FROM meta WHERE key = 'merged'").fetchone() is not None
 
-    def calculate_hash(self, file_path, chunk_size=8192):
-        """Calculate SHA-256 hash of a file"""
-        sha256 = hashlib.sha256()
+    def merge_shards(self, shard_paths):
+        """Bulk-copy shard indexes into this one, each under //volume
+
+        Each shard is copied with INSERT ... SELECT in one transaction, in
+        (directory, name) order so rows and the unique index are appended
+        rather than inserted at random; secondary indexes are dropped first
+        and rebuilt once at the end.  A volume that was merged before is
+        replaced.
+        """
+        shards = []
+        for shard_path in shard_paths:
+            volume, hash_algorithm, merged = read_shard(shard_path)
+            if merged:
+                raise ValueError(f"{shard_path} is a merged index; merge its shards instead")
+            shards.append((shard_path, volume, hash_algorithm))
+        names = [volume for _, volume, _ in shards]
+        for volume in set(names):
+            if names.count(volume) > 1:
+                raise ValueError(f"More than one shard is named {volume!r}; rename them with `scan --volume`")
+
+        has_files = self.conn.execute("SELECT 1 FROM files LIMIT 1").fetchone()
+        if not self.merged:
+            if has_files:
+                raise ValueError(f"{self.db_path} already indexes files itself; merge into a new database")
+            with self.conn:
+                self.conn.execute("DELETE FROM volumes")
+                self.conn.execute("INSERT INTO meta (key, value) VALUES ('merged', '1')")
+
+        conn = self.conn
+        for index in ('idx_hash', 'idx_size', 'idx_inode'):
+            conn.execute(f"DROP INDEX IF EXISTS {index}")
         try:
-            with open(file_path, 'rb') as f:
-                while chunk := f.read(chunk_size):
-                    sha256.update(chunk)
-            return sha256.hexdigest()
+            for shard_path, volume, hash_algorithm in shards:
+                self.hash_algorithm = self.init_hash_algorithm(hash_algorithm)
+                started = time.monotonic()
+                conn.execute("ATTACH DATABASE ? AS shard", (shard_uri(shard_path),))
+                try:
+                    count = self._merge_shard(volume)
+                finally:
+                    conn.execute("DETACH DATABASE shard")
+                print(f"Merged {shard_path} as {VOLUME_PREFIX}{volume}: {count:,} files in {time.monotonic() - started:.1f}s")
+
+            with conn:
+                # The root of a merged index totals every volume
+                conn.execute("DELETE FROM dirs WHERE path = ?", (VOLUME_PREFIX,))
+                conn.execute("""
+                    INSERT INTO dirs (path, depth, file_count, total_size, tree_count, tree_size)
+                    SELECT ?, 0, 0, 0, COALESCE(SUM(tree_count), 0), COALESCE(SUM(tree_size), 0)
+                    FROM dirs WHERE depth = 1
+                """, (VOLUME_PREFIX,))
+        finally:
+            print("Rebuilding indexes...")
+            self.create_tables()
+            conn.commit()
+
+    def _merge_shard(self, volume):
+        """Copy the attached `shard` database in as volume, replacing any earlier copy"""
+        conn = self.conn
+        with conn:
+            row = conn.execute("SELECT id FROM volumes WHERE name = ?", (volume,)).fetchone()
+            if row:
+                volume_id = row[0]
+                lower, upper = dir_range(VOLUME_PREFIX + volume)
+                conn.execute("""
+                    CREATE TEMP TABLE old_dirs AS
+                    SELECT id FROM dirs WHERE path = ? OR (path >= ? AND path < ?)
+                """, (VOLUME_PREFIX + volume, lower, upper))
+                conn.execute("DELETE FROM files WHERE dir_id IN (SELECT id FROM temp.old_dirs)")
+                conn.execute("DELETE FROM dirs WHERE id IN (SELECT id FROM temp.old_dirs)")
+                conn.execute("DROP TABLE temp.old_dirs")
+                conn.execute("DELETE FROM scans WHERE root >= ? AND root < ?", (lower, upper))
+            else:
+                volume_id = conn.execute("INSERT INTO volumes (name) VALUES (?)", (volume,)).lastrowid
+
+            offset = conn.execute(
+                "SELECT MAX(COALESCE((SELECT MAX(id) FROM dirs), 0), COALESCE((SELECT MAX(id) FROM scans), 0))"
+            ).fetchone()[0]
+            dirs, files, scans = volume_selects('shard', volume, volume_id, offset, keep_file_ids=False)
+            conn.execute(f"INSERT INTO scans (id, root, started, finished) {scans}")
+            conn.execute(f"""
+                INSERT INTO dirs (id, path, depth, file_count, total_size, tree_count, tree_size,
+                                  largest_size, largest_name, mtime, subdirs)
+                {dirs}
+            """)
+            return conn.execute(f"""
+                INSERT INTO files (id, dir_id, name, size, hash, hash_state, mtime, scan_id, dev, ino, volume_id)
+                {files} ORDER BY shard.files.dir_id, shard.files.name
+            """).rowcount
+
+    def attach_shards(self, shard_paths):
+        """Query this index and other shard indexes together, without copying them
+
+        Temporary `dirs`, `files` and `volumes` views shadow the tables of
+        this connection, so every query sees one index laid out like `merge`
+        output.  SQLite allows only a handful of attached databases; merge
+        anything bigger.
+        """
+        if self.merged:
+            raise ValueError(f"{self.db_path} is a merged index; merge the other shards into it instead")
+        shards = [('main', self.volume, self.hash_algorithm)]
+        for i, shard_path in enumerate(shard_paths, 1):
+            volume, hash_algorithm, merged = read_shard(shard_path)
+            if merged:
+                raise ValueError(f"{shard_path} is a merged index; merge the shards instead")
+            if hash_algorithm != self.hash_algorithm:
+                raise ValueError(f"{shard_path} is indexed with {hash_algorithm}, not {self.hash_algorithm}")
+            shards.append((f"shard{i}", volume, hash_algorithm))
+            try:
+                self.conn.execute(f"ATTACH DATABASE ? AS shard{i}", (shard_uri(shard_path),))
+            except sqlite3.OperationalError as e:
+                raise ValueError(f"Can't attach {shard_path} ({e}); merge the shards instead")
+        names = [volume for _, volume, _ in shards]
+        for volume in set(names):
+            if names.count(volume) > 1:
+                raise ValueError(f"More than one shard is named {volume!r}; rename them with `scan --volume`")
+
+        selects = [
+            volume_selects(schema, volume, volume_id, volume_id * SHARD_ID_SPACING)
+            for volume_id, (schema, volume, _) in enumerate(shards, 1)
+        ]
+        dirs = " UNION ALL ".join(dirs for dirs, _, _ in selects)
+        self.conn.executescript(f"""
+            CREATE TEMP VIEW dirs AS {dirs}
+            UNION ALL
+            SELECT 0, {sql_quote(VOLUME_PREFIX)}, 0, 0, 0, SUM(tree_count), SUM(tree_size), NULL, NULL, NULL, NULL
+            FROM ({dirs}) WHERE depth = 1;
+            CREATE TEMP VIEW files AS {" UNION ALL ".join(files for _, files, _ in selects)};
+            CREATE TEMP VIEW volumes AS {" UNION ALL ".join(
+                f"SELECT {volume_id} AS id, {sql_quote(volume)} AS name"
+                for volume_id, (_, volume, _) in enumerate(shards, 1)
+            )};
+        """)
+
+    def calculate_hash(self, file_path):
+        """Calculate the hash of a file with the database's algorithm"""
+        try:
+            return digest_file(file_path, self.hash_algorithm, self.read_size, self.use_mmap)
         except (PermissionError, OSError) as e:
             print(f"Warning: Could not read {file_path}: {e}", file=sys.stderr)
             return None
 
-    def scan_directory(self, root_path, update=False):
-        """Scan directory tree and index all files"""
+    def calculate_content(self, file_path, spill):
+        """(hash, chunks) for a file, where chunks is None unless indexing chunks
+
+        chunks is (spill_id, records) for RowBatch: a big file's records are
+        passed to spill(spill_id, records) a batch at a time as they're made,
+        leaving only the last ones in records; spill_id is None if there were
+        no earlier batches.
+        """
+        if not self.chunks:
+            return self.calculate_hash(file_path), None
+        spill_id = None
+
+        def spill_batch(records):
+            nonlocal spill_id
+            if spill_id is None:
+                spill_id = next(_spill_ids)
+            spill(spill_id, records)
+
+        try:
+            file_hash, records = chunk_file(file_path, self.hash_algorithm, spill_batch)
+        except (PermissionError, OSError) as e:
+            print(f"Warning: Could not read {file_path}: {e}", file=sys.stderr)
+            return None, None
+        return file_hash, (spill_id, records)
+
+    def calculate_partial_hash(self, file_path, file_size):
+        """Hash the first and last PARTIAL_HASH_SIZE bytes of a file
+
+        Returns (hash, hash_state); files small enough to be covered entirely
+        get a full hash, so they never need a second pass.
+        """
+        if file_size <= 2 * PARTIAL_HASH_SIZE:
+            return self.calculate_hash(file_path), HASH_FULL
+        digest = HASH_ALGORITHMS[self.hash_algorithm]()
+        try:
+            with open(file_path, 'rb') as f:
+                digest.update(f.read(PARTIAL_HASH_SIZE))
+                f.seek(-PARTIAL_HASH_SIZE, os.SEEK_END)
+                digest.update(f.read(PARTIAL_HASH_SIZE))
+            return digest.digest(), HASH_PARTIAL
+        except (PermissionError, OSError) as e:
+            print(f"Warning: Could not read {file_path}: {e}", file=sys.stderr)
+            return None, HASH_PARTIAL
+
+    def scan_directory(self, root_path, update=False, jobs=1, lazy=False, quick=False, resume=False):
+        """Scan directory tree and index all files, dropping indexed files that are gone
+
+        With jobs > 1, hashing runs on a thread pool (hashlib and file reads
+        release the GIL) while a single ScanWriter thread batches the upserts.
+
+        With lazy, the walk records only size and mtime, then
+        resolve_collisions hashes just enough to tell same-size files apart.
+
+        With quick, directories whose mtime hasn't changed since the last scan
+        aren't listed and their files aren't checked (see TreeWalk).
+
+        Every directory whose files are all written is checkpointed in
+        `scan_dirs`; with resume, the last interrupted scan of root_path
+        carries on without looking at the directories it finished.
+
+        When indexing chunks, files that haven't been chunked yet are read
+        even if they're unchanged.
+
+        Returns the scan's ScanProgress.metrics(), or None if it didn't run.
+        """
         root_path = Path(root_path).resolve()
 
         if not root_path.exists():
             print(f"Error: Path does not exist: {root_path}", file=sys.stderr)
             return
+        if self.merged:
+            print(f"Error: {self.db_path} is a merged index; scan a shard and merge it again", file=sys.stderr)
+            return
+        if self.chunks and lazy:
+            print("Error: --chunks reads every file, so it can't be combined with --lazy", file=sys.stderr)
+            return
 
         cursor = self.conn.cursor()
-        scan_time = datetime.now().isoformat()
-        files_processed = 0
-        files_updated = 0
-        files_added = 0
+        cursor.execute("""
+            SELECT id FROM scans WHERE root = ? AND finished IS NULL ORDER BY id DESC LIMIT 1
+        """, (str(root_path),))
+        row = cursor.fetchone()
+        progress = ScanProgress()
+        done = {}
+        if resume and row:
+            scan_id = row[0]
+            with progress.timed('lookup'):
+                done = self.load_checkpoint(scan_id)
+            print(f"Resuming scan {scan_id}: {len(done):,} directories already done")
+        else:
+            if resume:
+                print(f"No interrupted scan of {root_path} to resume")
+            with self.conn:
+                # Interrupted scans of this tree won't be resumed now
+                self.conn.execute("""
+                    DELETE FROM scan_dirs WHERE scan_id IN (SELECT id FROM scans WHERE root = ? AND finished IS NULL)
+                """, (str(root_path),))
+                cursor.execute("INSERT INTO scans (root, started) VALUES (?, ?)", (str(root_path), datetime.now().isoformat()))
+                scan_id = cursor.lastrowid
+        if self.chunks:
+            self.drop_spilled_chunks()
+        backfill = []  # (dev, ino, dir, name) for unchanged rows indexed before inodes were tracked
+        removed = []  # (path, size) for indexed files no longer in the tree
+        with progress.timed('lookup'):
+            walk = TreeWalk(root_path, self.load_dir_states(root_path) if quick and not update else None, done)
 
         print(f"Scanning: {root_path}")
 
-        for entry in root_path.rglob('*'):
-            if entry.is_file():
+        try:
+            if jobs > 1 and not lazy:
+                sizes = self._scan_parallel(walk, update, scan_id, progress, jobs, backfill, removed)
+            else:
+                sizes = self._scan_serial(walk, update, scan_id, progress, lazy, backfill, removed)
+        except KeyboardInterrupt:
+            print(f"\nScan interrupted: {progress.processed} files processed", file=sys.stderr)
+            print(f"  Added: {progress.added}, Updated: {progress.updated}", file=sys.stderr)
+            print(f"  Continue with: scan --resume {root_path}", file=sys.stderr)
+            raise
+
+        with progress.timed('write'):
+            with self.conn:
+                self.conn.executemany("""
+                    UPDATE files SET dev = ?, ino = ?
+                    WHERE dir_id = (SELECT id FROM dirs WHERE path = ?) AND name = ?
+                """, backfill)
+            self.remove_files(removed)
+            with self.conn:
+                # Quick scans trust these only once the whole scan is done
+                self.conn.execute("""
+                    UPDATE dirs SET mtime = s.mtime, subdirs = s.subdirs
+                    FROM scan_dirs s WHERE s.scan_id = ? AND s.path = dirs.path
+                """, (scan_id,))
+                self.conn.execute("DELETE FROM scan_dirs WHERE scan_id = ?", (scan_id,))
+                self.conn.execute("UPDATE scans SET finished = ? WHERE id = ?", (datetime.now().isoformat(), scan_id))
+            if self.chunks:
+                self.drop_spilled_chunks()
+
+        print(f"\nScan complete: {progress.processed} files processed")
+        print(f"  Added: {progress.added}, Updated: {progress.updated}, Removed: {len(removed)}")
+
+        if lazy or sizes:
+            with progress.timed('resolve'):
+                self.resolve_collisions(jobs=jobs, sizes=None if lazy else sizes, progress=progress)
+
+        metrics = progress.metrics()
+        metrics.update(root=str(root_path), scan_id=scan_id, removed=len(removed), jobs=jobs)
+        print(f"  Read: {metrics['hashed_files']:,} files, {self.format_size(metrics['hashed_bytes'])} "
+              f"({metrics['files_per_second']:,.0f} files/s, {metrics['mb_per_second']:,.1f} MB/s)")
+        print(f"  Time: {metrics['elapsed']:.2f}s (" + ", ".join(
+            f"{phase} {seconds:.2f}s" for phase, seconds in metrics['phases'].items()
+        ) + ")")
+        return metrics
+
+    def drop_spilled_chunks(self):
+        """Delete chunks written under a spill_id whose file row never followed (a read error or an interrupted scan)"""
+        with self.conn:
+            self.conn.execute("DELETE FROM chunks WHERE file_id < 0")
+
+    def load_known_files(self, root_path, subtree=True):
+        """Map dir -> {name -> (mtime, size, hash_state, ino, chunked)} for everything indexed under root_path, in one query
+
+        With subtree false, just the files directly in root_path.  chunked
+        is always true unless indexing chunks.
+        """
+        root_path = str(root_path)
+        lower, upper = dir_range(root_path) if subtree else (root_path, root_path)
+        cursor = self.conn.cursor()
+        cursor.execute(f"""
+            SELECT d.path, f.name, f.mtime, f.size, f.hash_state, f.ino, {self.chunked_sql() if self.chunks else 1}
+            FROM files f JOIN dirs d ON d.id = f.dir_id
+            WHERE d.path = ? OR (d.path >= ? AND d.path < ?)
+        """, (root_path, lower, upper))
+        known = {}
+        for dir_path, name, *existing in cursor:
+            known.setdefault(dir_path, {})[name] = tuple(existing)
+        return known
+
+    @staticmethod
+    def chunked_sql(alias='f'):
+        """SQL that's true for file rows whose chunks are indexed (empty files have none)"""
+        return f"({alias}.size = 0 OR EXISTS (SELECT 1 FROM chunks c WHERE c.file_id = {alias}.id))"
+
+    def load_dir_states(self, root_path):
+        """Map dir -> (mtime, subdirs, file_count) for directories indexed under root_path
+
+        mtime and subdirs are as of the last scan that listed the directory;
+        mtime is None if it never has been (or was too recently changed).
+        """
+        root_path = str(root_path)
+        lower, upper = dir_range(root_path)
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            SELECT path, mtime, subdirs, file_count FROM dirs
+            WHERE path = ? OR (path >= ? AND path < ?)
+        """, (root_path, lower, upper))
+        return {
+            dir_path: (mtime, subdirs.split(os.sep) if subdirs else [], file_count)
+            for dir_path, mtime, subdirs, file_count in cursor
+        }
+
+    def load_checkpoint(self, scan_id):
+        """Map dir -> (mtime, subdirs) for the directories an interrupted scan finished"""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT path, mtime, subdirs FROM scan_dirs WHERE scan_id = ?", (scan_id,))
+        return {
+            dir_path: (mtime, subdirs.split(os.sep) if subdirs else [])
+            for dir_path, mtime, subdirs in cursor
+        }
+
+    def remove_files(self, removed):
+        """Delete the rows of files that no longer exist, keeping the directory rollup in step"""
+        for start in range(0, len(removed), WRITE_BATCH_SIZE):
+            batch = removed[start:start + WRITE_BATCH_SIZE]
+            with self.conn:
+                self.conn.executemany("""
+                    DELETE FROM chunks WHERE file_id = (
+                        SELECT f.id FROM files f JOIN dirs d ON d.id = f.dir_id WHERE d.path = ? AND f.name = ?
+                    )
+                """, (os.path.split(path) for path, _ in batch))
+                self.conn.executemany(
+                    "DELETE FROM files WHERE dir_id = (SELECT id FROM dirs WHERE path = ?) AND name = ?",
+                    (os.path.split(path) for path, _ in batch),
+                )
+                update_dir_rollup(self.conn, [(path, None, size) for path, size in batch])
+
+    def lookup_inode_hash(self, st):
+        """Full hash already indexed for this inode under another path, if its content hasn't changed"""
+        cursor = self.conn.cursor()
+        cursor.execute(f"""
+            SELECT hash FROM files
+            WHERE dev = ? AND ino = ? AND mtime = ? AND size = ? AND hash_state = '{HASH_FULL}'
+            LIMIT 1
+        """, (st.st_dev, st.st_ino, st.st_mtime, st.st_size))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def inode_key(st):
+        """(dev, ino) for files that may share content with another path, else None"""
+        if st.st_nlink > 1 and st.st_ino:
+            return st.st_dev, st.st_ino
+        return None
+
+    @staticmethod
+    def file_row(file_path, st, file_hash, hash_state):
+        # Some platforms (e.g. scandir on Windows) report no inode numbers
+        dev, ino = (st.st_dev, st.st_ino) if st.st_ino else (None, None)
+        return file_path, st.st_size, file_hash, hash_state, st.st_mtime, dev, ino
+
+    def _pending_files(self, walk, update, progress, tracker, lazy=False, backfill=None, removed=None):
+        """Walk the tree, yielding (path, stat, old_size) for files that need hashing; old_size is None for new files
+
+        Each yielded file is added to tracker, and the consumer settles it.
+
+        Once the walk is done, indexed files that weren't found are appended
+        to removed as (path, size), except under directories that couldn't be
+        listed.
+
+        A quick walk (one with `previous` states) reads each directory's rows
+        only if it lists that directory, so unchanged trees cost one query.
+        """
+        quick = bool(walk.previous)
+        if quick:
+            known = {dir_path: None for dir_path, (_, _, file_count) in walk.previous.items() if file_count}
+            if not lazy:
+                # A full scan has to list directories with lazily-hashed (or unchunked) files to upgrade them
+                lower, upper = dir_range(walk.root_path)
+                upgrade = f"f.hash_state != '{HASH_FULL}'"
+                if self.chunks:
+                    upgrade += f" OR NOT {self.chunked_sql()}"
+                with progress.timed('lookup'):
+                    for (dir_path,) in self.conn.execute(f"""
+                        SELECT DISTINCT d.path FROM files f JOIN dirs d ON d.id = f.dir_id
+                        WHERE ({upgrade}) AND (d.path = ? OR (d.path >= ? AND d.path < ?))
+                    """, (walk.root_path, lower, upper)):
+                        walk.previous[dir_path] = (None, *walk.previous[dir_path][1:])
+        else:
+            with progress.timed('lookup'):
+                known = self.load_known_files(walk.root_path)
+
+        def pop_known(dir_path):
+            if quick and dir_path in known:
+                known.pop(dir_path)
+                with progress.timed('lookup'):
+                    return self.load_known_files(dir_path, subtree=False).get(dir_path, {})
+            return known.pop(dir_path, {})
+
+        for dir_path, entries, unreadable, state in progress.timed_iter('walk', walk):
+            if entries is None:
+                # An unchanged or already finished directory vouches for its files
+                files = known.pop(dir_path, None)
+                progress.advance(count=len(files) if files else walk.previous.get(dir_path, (0, 0, 0))[2])
+                if state:
+                    tracker.open(dir_path, *state)
+                    tracker.close(dir_path)
+                continue
+            files = pop_known(dir_path)
+            tracker.open(dir_path, *state)
+
+            stat_time = 0.0
+            for entry in entries:
+                existing = files.pop(entry.name, None)
                 try:
-                    file_path = str(entry)
-                    file_size = entry.stat().st_size
-                    file_mtime = entry.stat().st_mtime
-
-                    # Check if file already exists in database
-                    cursor.execute("SELECT mtime, hash FROM files WHERE path = ?", (file_path,))
-                    existing = cursor.fetchone()
-
-                    # Skip if file hasn't changed
-                    if existing and not update:
-                        if existing[0] == file_mtime:
-                            files_processed += 1
-                            if files_processed % 100 == 0:
-                                print(f"Processed {files_processed} files...", end='\r')
+                    start = time.perf_counter()
+                    st = entry.stat()
+                    stat_time += time.perf_counter() - start
+                except OSError as e:
+                    print(f"\nWarning: Could not process {entry.path}: {e}", file=sys.stderr)
+                    continue
+
+                # Skip if file hasn't changed (a full scan upgrades lazily-hashed and unchunked rows)
+                if existing and not update:
+                    mtime, size, hash_state, ino, chunked = existing
+                    if (mtime == st.st_mtime and size == st.st_size
+                            and (lazy or (hash_state == HASH_FULL and chunked))):
+                        if ino is None and st.st_ino and backfill is not None:
+                            backfill.append((st.st_dev, st.st_ino, dir_path, entry.name))
+                            progress.advance()
+                            continue
+                        if ino == st.st_ino or not st.st_ino:
+                            progress.advance()
                             continue
 
-                    # Calculate hash
-                    file_hash = self.calculate_hash(file_path)
+                tracker.add(entry.path)
+                yield entry.path, st, existing[1] if existing else None
+
+            progress.add_time('stat', stat_time)
+            tracker.close(dir_path)
+            if removed is not None:
+                removed.extend(
+                    (os.path.join(dir_path, name), existing[1])
+                    for name, existing in files.items() if name not in unreadable
+                )
+
+        if removed is not None:
+            # Directories left over were deleted or moved away, unless the walk couldn't get into them
+            for dir_path in list(known):
+                if not walk.is_failed(dir_path):
+                    removed.extend((os.path.join(dir_path, name), existing[1]) for name, existing in pop_known(dir_path).items())
+
+    def _scan_serial(self, walk, update, scan_id, progress, lazy=False, backfill=None, removed=None):
+        batch = RowBatch(self.conn, scan_id, progress)
+        tracker = DirTracker(batch.add_dir)
+        inode_hashes = {}  # Hash (and chunk) each hardlinked inode once per scan
+        clock = time.perf_counter
+        lookup_time = hash_time = 0.0
+        try:
+            for file_path, st, old_size in self._pending_files(walk, update, progress, tracker, lazy, backfill, removed):
+                # Calculate hash, unless it can wait for resolve_collisions
+                if lazy:
+                    file_hash, hash_state, chunks = None, HASH_NONE, None
+                else:
+                    key = self.inode_key(st)
+                    file_hash, chunks = inode_hashes.get(key, (None, None)) if key else (None, None)
+                    if file_hash is None and (key or old_size is None) and not self.chunks:
+                        # Hardlinks and renamed files are already hashed under another path
+                        start = clock()
+                        file_hash = self.lookup_inode_hash(st)
+                        lookup_time += clock() - start
                     if file_hash is None:
+                        start = clock()
+                        file_hash, chunks = self.calculate_content(file_path, batch.add_spilled)
+                        hash_time += clock() - start
+                        if file_hash is not None:
+                            progress.add_hashed(st.st_size)
+                    if file_hash is None:
+                        tracker.settle(file_path)
                         continue
+                    if key:
+                        inode_hashes[key] = file_hash, chunks
+                    hash_state = HASH_FULL
+                batch.add(self.file_row(file_path, st, file_hash, hash_state), old_size, chunks)
+                tracker.settle(file_path)
+        finally:
+            progress.add_time('lookup', lookup_time)
+            progress.add_time('hash', hash_time)
+            # Every row is complete on its own, so keep what was hashed even on Ctrl-C
+            batch.flush()
+        return batch.sizes
+
+    def _scan_parallel(self, walk, update, scan_id, progress, jobs, backfill=None, removed=None):
+        writer = ScanWriter(self.db_path, scan_id, progress)
+        writer.start()
+        tracker = DirTracker(writer.put_dir)
+        stopping = threading.Event()
+        in_flight = threading.BoundedSemaphore(jobs * 4)  # Bound memory on huge trees
+        inode_hashes = {}  # (dev, ino) -> Future of (hash, chunks), so hardlinked content is hashed once
+
+        def hash_file(file_path, st, old_size):
+            try:
+                if stopping.is_set():
+                    return None, None
+                with progress.timed('hash'):
+                    file_hash, chunks = self.calculate_content(file_path, writer.put_spilled)
+                if file_hash is not None:
+                    progress.add_hashed(st.st_size)
+                    writer.put(self.file_row(file_path, st, file_hash, HASH_FULL), old_size, chunks)
+                tracker.settle(file_path)
+                return file_hash, chunks
+            finally:
+                in_flight.release()
 
-                    # Insert or update
-                    if existing:
-                        cursor.execute("""
-                            UPDATE files
-                            SET size = ?, hash = ?, mtime = ?, scan_time = ?
-                            WHERE path = ?
-                        """, (file_size, file_hash, file_mtime, scan_time, file_path))
-                        files_updated += 1
-                    else:
-                        cursor.execute("""
-                            INSERT INTO files (path, size, hash, mtime, scan_time)
-                            VALUES (?, ?, ?, ?, ?)
-                        """, (file_path, file_size, file_hash, file_mtime, scan_time))
-                        files_added += 1
-
-                    files_processed += 1
-
-                    if files_processed % 100 == 0:
-                        print(f"Processed {files_processed} files...", end='\r')
-                        self.conn.commit()
-
-                except (PermissionError, OSError) as e:
-                    print(f"\nWarning: Could not process {entry}: {e}", file=sys.stderr)
+        def link_to(file_path, st, old_size):
+            def put_linked(future):
+                if future.cancelled() or stopping.is_set():
+                    return  # Left unsettled, so its directory isn't checkpointed
+                file_hash, chunks = future.result()
+                if file_hash is not None:
+                    writer.put(self.file_row(file_path, st, file_hash, HASH_FULL), old_size, chunks)
+                tracker.settle(file_path)
+            return put_linked
+
+        from concurrent.futures import Future, ThreadPoolExecutor  # Slow to import, and serial scans don't need it
+        pool = ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="dennisfile-hash")
+        try:
+            pending = self._pending_files(walk, update, progress, tracker, backfill=backfill, removed=removed)
+            for file_path, st, old_size in pending:
+                key = self.inode_key(st)
+                if key in inode_hashes:
+                    inode_hashes[key].add_done_callback(link_to(file_path, st, old_size))
                     continue
+                file_hash = None
+                if (key or old_size is None) and not self.chunks:
+                    with progress.timed('lookup'):
+                        file_hash = self.lookup_inode_hash(st)
+                if file_hash:
+                    if key:
+                        future = Future()
+                        future.set_result((file_hash, None))
+                        inode_hashes[key] = future
+                    writer.put(self.file_row(file_path, st, file_hash, HASH_FULL), old_size)
+                    tracker.settle(file_path)
+                    continue
+                in_flight.acquire()
+                future = pool.submit(hash_file, file_path, st, old_size)
+                if key:
+                    inode_hashes[key] = future
+        except KeyboardInterrupt:
+            stopping.set()
+            raise
+        finally:
+            # Let in-progress hashes land, then flush and commit whatever is queued
+            pool.shutdown(wait=True, cancel_futures=stopping.is_set())
+            writer.close()
+        return writer.sizes
 
-        self.conn.commit()
-        print(f"\nScan complete: {files_processed} files processed")
-        print(f"  Added: {files_added}, Updated: {files_updated}")
+    def resolve_collisions(self, jobs=1, sizes=None, progress=None):
+        """Hash only what's needed to tell same-size files apart
 
-    def find_duplicates(self, min_size=0):
-        """Find duplicate files based on hash"""
+        For each size shared by more than one inode, compare partial hashes
+        (first and last PARTIAL_HASH_SIZE bytes), then fully hash only the
+        files whose partial hashes still collide.  Hardlinks are hashed once
+        and never count as a collision with each other.
+
+        Without sizes, checks every size with an unhashed file (after a lazy
+        scan); with sizes, just those, wherever a lazily-hashed file could now
+        match a fully-hashed newcomer (after a full scan).
+
+        Every partial and full hash is counted in progress, if given, as
+        content read.
+        """
         cursor = self.conn.cursor()
+        if sizes is None:
+            cursor.execute(f"""
+                SELECT size FROM files f
+                GROUP BY size
+                HAVING COUNT(DISTINCT {INODE_KEY}) > 1 AND SUM(hash_state = '{HASH_NONE}') > 0
+            """)
+        else:
+            cursor.execute("CREATE TEMP TABLE IF NOT EXISTS scan_sizes (size INTEGER PRIMARY KEY)")
+            cursor.execute("DELETE FROM temp.scan_sizes")
+            cursor.executemany("INSERT INTO temp.scan_sizes (size) VALUES (?)", ((size,) for size in sizes))
+            cursor.execute(f"""
+                SELECT size FROM files f
+                WHERE size IN (SELECT size FROM temp.scan_sizes)
+                GROUP BY size
+                HAVING COUNT(DISTINCT {INODE_KEY}) > 1 AND SUM(hash_state != '{HASH_FULL}') > 0
+            """)
+        sizes = [size for (size,) in cursor.fetchall()]
+        if not sizes:
+            return
 
-        cursor.execute("""
-            SELECT hash, COUNT(*) as count, SUM(size) as total_size
-            FROM files
-            WHERE size >= ?
-            GROUP BY hash
-            HAVING count > 1
-            ORDER BY total_size DESC
+        print(f"Resolving {len(sizes)} size collisions...")
+        pool = None
+        if jobs > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            pool = ThreadPoolExecutor(max_workers=jobs)
+        hash_map = pool.map if pool else map
+        state_rank = {HASH_NONE: 0, HASH_PARTIAL: 1, HASH_FULL: 2}
+        partial_count = full_count = 0
+
+        def store(ids, file_hash, hash_state):
+            cursor.executemany(
+                "UPDATE files SET hash = ?, hash_state = ? WHERE id = ?",
+                [(file_hash, hash_state, row_id) for row_id in ids],
+            )
+
+        try:
+            for n, size in enumerate(sizes, 1):
+                cursor.execute(f"""
+                    SELECT f.id, {FILE_PATH}, f.hash, f.hash_state, {INODE_KEY}
+                    FROM files f JOIN dirs d ON d.id = f.dir_id
+                    WHERE f.size = ?
+                """, (size,))
+
+                # One representative per inode: [ids, path, hash, hash_state] with the most complete hash
+                inodes = {}
+                mixed = {}  # Inodes whose hardlinks were hashed to different extents
+                for row_id, path, file_hash, hash_state, inode in cursor.fetchall():
+                    rep = inodes.setdefault(inode, [[], path, file_hash, hash_state])
+                    rep[0].append(row_id)
+                    if hash_state != rep[3]:
+                        mixed[inode] = rep
+                    if state_rank[hash_state] > state_rank[rep[3]]:
+                        rep[1:] = [path, file_hash, hash_state]
+                reps = list(inodes.values())
+
+                # Partial pass; fully-hashed files need a comparable key too, but it isn't stored
+                def partial_key(rep):
+                    ids, path, file_hash, hash_state = rep
+                    if hash_state == HASH_PARTIAL or (hash_state == HASH_FULL and size <= 2 * PARTIAL_HASH_SIZE):
+                        return file_hash, hash_state
+                    key, key_state = self.calculate_partial_hash(path, size)
+                    if progress and key is not None:
+                        progress.add_hashed(min(size, 2 * PARTIAL_HASH_SIZE))
+                    return key, key_state
+
+                def full_hash(rep):
+                    file_hash = self.calculate_hash(rep[1])
+                    if progress and file_hash is not None:
+                        progress.add_hashed(size)
+                    return file_hash
+
+                groups = {}
+                for rep, (key, key_state) in zip(reps, hash_map(partial_key, reps)):
+                    if key is None:
+                        continue
+                    if rep[3] == HASH_NONE or (rep[3] == HASH_PARTIAL and key_state == HASH_FULL):
+                        rep[2:] = [key, key_state]
+                        store(rep[0], key, key_state)
+                        partial_count += len(rep[0])
+                    groups.setdefault(key, []).append(rep)
+
+                # Full pass, only where partial hashes still collide
+                to_hash = [
+                    rep for group in groups.values() if len(group) > 1
+                    for rep in group if rep[3] != HASH_FULL
+                ]
+                for rep, file_hash in zip(to_hash, hash_map(full_hash, to_hash)):
+                    if file_hash is None:
+                        continue
+                    store(rep[0], file_hash, HASH_FULL)
+                    full_count += len(rep[0])
+
+                # Bring new hardlinks of an already-resolved inode up to date
+                for ids, _, file_hash, hash_state in mixed.values():
+                    store(ids, file_hash, hash_state)
+
+                if n % PROGRESS_INTERVAL == 0:
+                    print(f"Resolved {n} of {len(sizes)} sizes...", end='\r')
+                    self.conn.commit()
+        finally:
+            self.conn.commit()
+            if pool:
+                pool.shutdown(cancel_futures=True)
+
+        print(f"\nPartial pass: {partial_count} files, full pass: {full_count} files")
+
+    def duplicate_sets(self, min_size=0):
+        """Yield (hash, size, copies, files) for each duplicate set, most wasted space first
+
+        One ordered query streams every duplicate row; rows are grouped as they
+        arrive, so memory stays bounded by the largest set.  `files` is a list
+        of (path, is_hardlink), where hardlinks follow the copy they share an
+        inode with.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(f"""
+            WITH sets AS (
+                SELECT hash, COUNT(DISTINCT {INODE_KEY}) as copies, MAX(size) as size
+                FROM files f
+                WHERE size >= ? AND hash_state = '{HASH_FULL}'
+                GROUP BY hash
+                HAVING COUNT(*) > 1 AND copies > 1
+            )
+            SELECT s.hash, s.size, s.copies, {FILE_PATH} as path, {INODE_KEY} as inode
+            FROM sets s
+            JOIN files f ON f.hash = s.hash AND f.hash_state = '{HASH_FULL}'
+            JOIN dirs d ON d.id = f.dir_id
+            ORDER BY s.size * s.copies DESC, s.hash, inode, path
         """, (min_size,))
 
-        duplicates = cursor.fetchall()
+        current, files, last_inode = None, [], None
+        for file_hash, size, copies, path, inode in cursor:
+            if current is not None and file_hash != current[0]:
+                yield (*current, files)
+                files, last_inode = [], None
+            current = (file_hash, size, copies)
+            files.append((path, inode == last_inode))
+            last_inode = inode
+        if current is not None:
+            yield (*current, files)
+
+    def find_duplicates(self, min_size=0, output_format='text', out=None):
+        """Report duplicate files; hardlinks share storage, so only distinct inodes count as copies
 
-        if not duplicates:
-            print("No duplicates found.")
+        Formats: `text` for people, `json` (one object per set per line), `csv`
+        (one row per path), and `null` (NUL-terminated paths with an empty
+        record between sets, for `xargs -0`-style tools).
+        """
+        out = out or sys.stdout
+        sets = self.duplicate_sets(min_size)
+
+        if output_format == 'json':
+            for file_hash, size, copies, files in sets:
+                out.write(json.dumps({
+                    'hash': file_hash.hex(),
+                    'size': size,
+                    'copies': copies,
+                    'wasted': size * (copies - 1),
+                    'files': [{'path': path, 'hardlink': hardlink} for path, hardlink in files],
+                }) + '\n')
             return
 
-        total_wasted = 0
-        print(f"\nFound {len(duplicates)} sets of duplicate files:\n")
+        if output_format == 'csv':
+            writer = csv.writer(out)
+            writer.writerow(['hash', 'size', 'copies', 'wasted', 'path', 'hardlink'])
+            for file_hash, size, copies, files in sets:
+                digest, wasted = file_hash.hex(), size * (copies - 1)
+                writer.writerows([digest, size, copies, wasted, path, int(hardlink)] for path, hardlink in files)
+            return
 
-        for file_hash, count, total_size in duplicates:
-            wasted_space = total_size - (total_size // count)
-            total_wasted += wasted_space
+        if output_format == 'null':
+            for file_hash, size, copies, files in sets:
+                out.write(''.join(f"{path}\0" for path, _ in files) + '\0')
+            return
 
-            print(f"Hash: {file_hash[:16]}... ({count} copies, {self.format_size(total_size)} total, {self.format_size(wasted_space)} wasted)")
+        set_count = total_wasted = 0
+        for file_hash, size, copies, files in sets:
+            total_size = size * copies
+            wasted_space = size * (copies - 1)
+            set_count += 1
+            total_wasted += wasted_space
 
-            cursor.execute("SELECT path, size FROM files WHERE hash = ?", (file_hash,))
-            for path, size in cursor.fetchall():
-                print(f"  - {path} ({self.format_size(size)})")
-            print()
+            links = f" + {len(files) - copies} hardlinks" if len(files) > copies else ""
+            print(f"Hash: {file_hash.hex()[:16]}... ({copies} copies{links}, {self.format_size(total_size)} total, {self.format_size(wasted_space)} wasted)", file=out)
+            for path, hardlink in files:
+                if hardlink:
+                    print(f"      = {path} (hardlink)", file=out)
+                else:
+                    print(f"  - {path} ({self.format_size(size)})", file=out)
+            print(file=out)
 
-        print(f"Total wasted space: {self.format_size(total_wasted)}")
+        if not set_count:
+            print("No duplicates found.", file=out)
+            return
+        print(f"Found {set_count} sets of duplicate files", file=out)
+        print(f"Total wasted space: {self.format_size(total_wasted)}", file=out)
 
-    def show_usage(self, path_prefix=None):
-        """Show space usage statistics"""
+    def show_usage(self, path_prefix=None, depth=None, limit=10):
+        """Show space usage statistics, answered from the `dirs` rollup where possible"""
         cursor = self.conn.cursor()
 
         if path_prefix:
-            cursor.execute("""
-                SELECT COUNT(*), SUM(size)
-                FROM files
-                WHERE path LIKE ?
-            """, (f"{path_prefix}%",))
+            dir_path = os.path.abspath(path_prefix)
+            cursor.execute("SELECT tree_count, tree_size FROM dirs WHERE path = ?", (dir_path,))
+            row = cursor.fetchone()
+            if row is None:
+                # Not an indexed directory, so fall back to matching any path prefix
+                return self._show_prefix_usage(path_prefix, limit)
         else:
-            cursor.execute("SELECT COUNT(*), SUM(size) FROM files")
+            # The deepest directory holding every file is the root of the whole index
+            cursor.execute("""
+                SELECT path, tree_count, tree_size FROM dirs
+                WHERE tree_count = (SELECT MAX(tree_count) FROM dirs)
+                ORDER BY depth DESC LIMIT 1
+            """)
+            row = cursor.fetchone()
+            if row is None:
+                print("No files found.")
+                return
+            dir_path, *row = row
+        count, total_size = row
+
+        print(f"\nTotal files: {count:,}")
+        print(f"Total size: {self.format_size(total_size or 0)}")
+
+        if depth is not None:
+            lower, upper = dir_range(dir_path)
+            cursor.execute("""
+                SELECT path, tree_count, tree_size FROM dirs
+                WHERE (path = ? OR (path >= ? AND path < ?)) AND depth <= ?
+                ORDER BY path
+            """, (dir_path, lower, upper, dir_depth(dir_path) + depth))
+            print("\nDirectories:")
+            for path, tree_count, tree_size in cursor.fetchall():
+                print(f"  {self.format_size(tree_size):>10} {tree_count:>12,} files  {path}")
+
+        # Show largest files
+        print("\nLargest files:")
+        for i, (path, size) in enumerate(self.largest_files(dir_path, limit), 1):
+            print(f"  {i}. {self.format_size(size):>10} - {path}")
+
+    def largest_files(self, dir_path, limit=10):
+        """The largest (path, size) files under dir_path
+
+        Each directory's largest file bounds the search: the limit-th biggest
+        of those is a floor for the answer, so only files at least that large
+        need to be looked at.
+        """
+        cursor = self.conn.cursor()
+        lower, upper = dir_range(dir_path)
+        cursor.execute("""
+            SELECT largest_size FROM dirs
+            WHERE (path = ? OR (path >= ? AND path < ?)) AND largest_size IS NOT NULL
+            ORDER BY largest_size DESC LIMIT 1 OFFSET ?
+        """, (dir_path, lower, upper, limit - 1))
+        row = cursor.fetchone()
+        floor = row[0] if row else 0
+        cursor.execute(f"""
+            SELECT {FILE_PATH}, f.size
+            FROM files f JOIN dirs d ON d.id = f.dir_id
+            WHERE f.size >= ? AND (d.path = ? OR (d.path >= ? AND d.path < ?))
+            ORDER BY f.size DESC LIMIT ?
+        """, (floor, dir_path, lower, upper, limit))
+        return cursor.fetchall()
+
+    def _show_prefix_usage(self, path_prefix, limit):
+        cursor = self.conn.cursor()
+        cursor.execute(f"""
+            SELECT COUNT(*), SUM(f.size)
+            FROM files f JOIN dirs d ON d.id = f.dir_id
+            WHERE {FILE_PATH} LIKE ?
+        """, (f"{path_prefix}%",))
 
         count, total_size = cursor.fetchone()
 
@@ -182,40 +2020,130 @@ class DennisFile:
         print(f"\nTotal files: {count:,}")
         print(f"Total size: {self.format_size(total_size or 0)}")
 
-        # Show largest files
         print("\nLargest files:")
-        cursor.execute("""
-            SELECT path, size
-            FROM files
-            ORDER BY size DESC
-            LIMIT 10
-        """)
+        cursor.execute(f"""
+            SELECT {FILE_PATH}, f.size
+            FROM files f JOIN dirs d ON d.id = f.dir_id
+            WHERE {FILE_PATH} LIKE ?
+            ORDER BY f.size DESC
+            LIMIT ?
+        """, (f"{path_prefix}%", limit))
 
         for i, (path, size) in enumerate(cursor.fetchall(), 1):
             print(f"  {i}. {self.format_size(size):>10} - {path}")
 
+    def dedup_estimate(self, path_prefix=None, depth=1):
+        """Estimate how much space chunk-level deduplication would save under a directory
+
+        Over the chunks of every file under the directory (hardlinked paths
+        once), the first copy of each chunk in index order is stored and
+        every later copy is saved.  SQLite numbers the copies with a window
+        query whose sort spills to temporary files, so memory use doesn't
+        grow with the index; only the totals of the directories shown, down
+        to depth levels below, are kept here.
+        """
+        cursor = self.conn.cursor()
+        if cursor.execute("SELECT 1 FROM chunks LIMIT 1").fetchone() is None:
+            print("No chunks indexed; run `scan --chunks` first.")
+            return
+
+        if path_prefix:
+            dir_path = os.path.abspath(path_prefix)
+        else:
+            cursor.execute("""
+                SELECT path FROM dirs
+                WHERE tree_count = (SELECT MAX(tree_count) FROM dirs)
+                ORDER BY depth DESC LIMIT 1
+            """)
+            dir_path = cursor.fetchone()[0]
+
+        self.conn.execute("PRAGMA temp_store = FILE")
+        lower, upper = dir_range(dir_path)
+        cursor.execute(f"""
+            WITH tree_files AS (
+                SELECT MIN(f.id) AS id FROM files f JOIN dirs d ON d.id = f.dir_id
+                WHERE d.path = ? OR (d.path >= ? AND d.path < ?)
+                GROUP BY {INODE_KEY}
+            ),
+            copies AS (
+                SELECT c.file_id, c.size,
+                       ROW_NUMBER() OVER (PARTITION BY c.hash ORDER BY c.file_id, c.offset) > 1 AS repeated
+                FROM chunks c WHERE c.file_id IN tree_files
+            )
+            SELECT d.path, COUNT(DISTINCT c.file_id), COUNT(*), SUM(c.size), SUM(c.repeated * c.size)
+            FROM copies c JOIN files f ON f.id = c.file_id JOIN dirs d ON d.id = f.dir_id
+            GROUP BY d.path
+        """, (dir_path, lower, upper))
+
+        totals = {}  # dir -> [files, chunks, bytes, saved]
+        for path, *counts in cursor:
+            parts = Path(os.path.relpath(path, dir_path)).parts if path != dir_path else ()
+            for level in range(min(depth, len(parts)) + 1):
+                totals_row = totals.setdefault(os.path.join(dir_path, *parts[:level]), [0, 0, 0, 0])
+                for i, count in enumerate(counts):
+                    totals_row[i] += count
+
+        if dir_path not in totals:
+            print("No chunked files found.")
+            return
+        file_count, chunk_count, total_size, saved = totals[dir_path]
+        print(f"\nChunked files: {file_count:,} ({chunk_count:,} chunks)")
+        print(f"Chunked size: {self.format_size(total_size)}")
+        print(f"Unique data: {self.format_size(total_size - saved)}")
+        print(f"Duplicate data: {self.format_size(saved)} ({saved / total_size:.1%})")
+
+        if depth:
+            print("\nDirectories:")
+            for path in sorted(totals):
+                _, _, total_size, saved = totals[path]
+                print(f"  {self.format_size(total_size):>10} {self.format_size(saved):>10} saved "
+                      f"{saved / total_size if total_size else 0:>6.1%}  {path}")
+
     def show_stats(self):
         """Show database statistics"""
         cursor = self.conn.cursor()
 
-        cursor.execute("SELECT COUNT(*), SUM(size) FROM files")
-        count, total_size = cursor.fetchone()
+        cursor.execute(f"SELECT COUNT(*), SUM(size), COUNT(DISTINCT {INODE_KEY}) FROM files f")
+        count, total_size, inode_count = cursor.fetchone()
 
-        cursor.execute("SELECT COUNT(DISTINCT hash) FROM files")
-        unique_count = cursor.fetchone()[0]
+        # Lazily-hashed files were never hashed fully because nothing else matched them
+        cursor.execute(f"""
+            SELECT COUNT(DISTINCT CASE WHEN hash_state = 'full' THEN hash END),
+                   COUNT(DISTINCT CASE WHEN hash_state != 'full' THEN {INODE_KEY} END),
+                   SUM(hash_state = 'partial'), SUM(hash_state = 'none')
+            FROM files f
+        """)
+        full_unique, lazy_unique, partial_count, unhashed_count = cursor.fetchone()
+        unique_count = full_unique + lazy_unique
 
-        cursor.execute("""
+        cursor.execute(f"""
             SELECT COUNT(*) FROM (
-                SELECT hash FROM files GROUP BY hash HAVING COUNT(*) > 1
+                SELECT hash FROM files f WHERE hash_state = 'full'
+                GROUP BY hash HAVING COUNT(DISTINCT {INODE_KEY}) > 1
             )
         """)
         duplicate_sets = cursor.fetchone()[0]
 
+        # Hardlinked paths only take up space once
+        cursor.execute(f"SELECT SUM(size) FROM (SELECT MAX(size) as size FROM files f GROUP BY {INODE_KEY})")
+        disk_size = cursor.fetchone()[0]
+
+        cursor.execute("SELECT name FROM volumes ORDER BY id")
+        volumes = [name for (name,) in cursor.fetchall()]
+
         print(f"\nDatabase: {self.db_path}")
+        print(f"{'Volumes' if len(volumes) > 1 else 'Volume'}: {', '.join(volumes)}")
+        print(f"Hash algorithm: {self.hash_algorithm}")
         print(f"Total files indexed: {count:,}")
+        if count > inode_count:
+            print(f"Hardlinked paths: {count - inode_count:,}")
         print(f"Unique files: {unique_count:,}")
         print(f"Duplicate sets: {duplicate_sets:,}")
+        if partial_count or unhashed_count:
+            print(f"Partially hashed: {partial_count or 0:,}, Size only: {unhashed_count or 0:,}")
         print(f"Total size: {self.format_size(total_size or 0)}")
+        if count > inode_count:
+            print(f"Size on disk: {self.format_size(disk_size or 0)}")
 
     @staticmethod
     def format_size(size):
@@ -232,6 +2160,17 @@ class DennisFile:
             self.conn.close()
 
 
+def write_metrics(metrics, path):
+    """Dump metrics as JSON to path, or stdout for -"""
+    if path == '-':
+        json.dump(metrics, sys.stdout, indent=2)
+        print()
+        return
+    with open(path, 'w') as f:
+        json.dump(metrics, f, indent=2)
+        f.write('\n')
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Dennis File - Index files and find duplicates",
@@ -239,9 +2178,22 @@ def main():
         epilog="""
 Examples:
   %(prog)s scan /path/to/directory
+  %(prog)s scan --jobs 8 /path/to/directory
+  %(prog)s scan --lazy /path/to/directory
+  %(prog)s scan --quick /path/to/directory
+  %(prog)s scan --resume /path/to/directory
+  %(prog)s scan --chunks /path/to/directory
+  %(prog)s --db media.db scan --hash blake2b /path/to/directory
   %(prog)s duplicates
+  %(prog)s duplicates --format null | tr -s '\\0' | xargs -0 ls -l  # tr drops the empty records between sets
   %(prog)s usage
+  %(prog)s usage --path /path/to/directory --depth 2
   %(prog)s stats
+  %(prog)s dedup-estimate --path /path/to/directory --depth 2
+  %(prog)s merge host1.db host2.db -o fleet.db
+  %(prog)s --db host1.db duplicates --attach host2.db
+  %(prog)s bench-hash
+  %(prog)s bench-scan --shape tiny --shape dupes --metrics-json bench.json
         """
     )
 
@@ -253,6 +2205,16 @@ Examples:
 
     subparsers = parser.add_subparsers(dest='command', help='Commands')
 
+    # Options for the commands that can query several shard indexes at once
+    shard_parser = argparse.ArgumentParser(add_help=False)
+    shard_parser.add_argument(
+        '--attach',
+        action='append',
+        default=[],
+        metavar='DB',
+        help='Also query this shard database in place, may be repeated'
+    )
+
     # Scan command
     scan_parser = subparsers.add_parser('scan', help='Scan a directory tree')
     scan_parser.add_argument('path', help='Directory path to scan')
@@ -261,25 +2223,159 @@ Examples:
         action='store_true',
         help='Force update of all files even if unchanged'
     )
+    scan_parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Number of parallel hashing threads (default: 1)'
+    )
+    scan_parser.add_argument(
+        '--lazy',
+        action='store_true',
+        help='Record size and mtime only; hash just enough to tell same-size files apart'
+    )
+    scan_parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Continue the last interrupted scan of this path from its checkpoint'
+    )
+    scan_parser.add_argument(
+        '--quick',
+        action='store_true',
+        help="Don't list directories whose mtime is unchanged (misses files edited in place)"
+    )
+    scan_parser.add_argument(
+        '--hash',
+        choices=sorted(HASH_ALGORITHMS),
+        help=f'Hash algorithm for a new database (default: {DEFAULT_HASH}); must match an existing one'
+    )
+    scan_parser.add_argument(
+        '--read-size',
+        type=int,
+        default=READ_SIZE // 1024,
+        help=f'Read buffer size in KiB (default: {READ_SIZE // 1024})'
+    )
+    scan_parser.add_argument(
+        '--mmap',
+        action='store_true',
+        help='Hash files from memory maps instead of read buffers'
+    )
+    scan_parser.add_argument(
+        '--chunks',
+        action='store_true',
+        help='Also index content-defined chunks of every file, for dedup-estimate'
+    )
+    scan_parser.add_argument(
+        '--volume',
+        help='Name for this host or volume in merged indexes (default: the host name)'
+    )
+    scan_parser.add_argument(
+        '--metrics-json',
+        metavar='FILE',
+        help='Write counts, throughput and per-phase times to FILE as JSON (- for stdout)'
+    )
 
     # Duplicates command
-    dup_parser = subparsers.add_parser('duplicates', help='Find duplicate files')
+    dup_parser = subparsers.add_parser('duplicates', help='Find duplicate files', parents=[shard_parser])
     dup_parser.add_argument(
         '--min-size',
         type=int,
         default=0,
         help='Minimum file size in bytes (default: 0)'
     )
+    dup_parser.add_argument(
+        '--format',
+        choices=['text', 'json', 'csv', 'null'],
+        default='text',
+        help='Output format: text, json (one set per line), csv (one path per row), '
+             'or null (NUL-separated paths, sets split by an empty record)'
+    )
 
     # Usage command
-    usage_parser = subparsers.add_parser('usage', help='Show space usage')
+    usage_parser = subparsers.add_parser('usage', help='Show space usage', parents=[shard_parser])
     usage_parser.add_argument(
         '--path',
         help='Filter by path prefix'
     )
+    usage_parser.add_argument(
+        '--depth',
+        type=int,
+        help='List directories up to this many levels below the path, like du'
+    )
 
     # Stats command
-    subparsers.add_parser('stats', help='Show database statistics')
+    subparsers.add_parser('stats', help='Show database statistics', parents=[shard_parser])
+
+    # Dedup-estimate command
+    dedup_parser = subparsers.add_parser('dedup-estimate', help='Estimate savings from chunk-level deduplication')
+    dedup_parser.add_argument(
+        '--path',
+        help='Directory to estimate (default: the root of the index)'
+    )
+    dedup_parser.add_argument(
+        '--depth',
+        type=int,
+        default=1,
+        help='List directories up to this many levels below the path (default: 1)'
+    )
+
+    # Merge command
+    merge_parser = subparsers.add_parser('merge', help='Combine shard databases into one index')
+    merge_parser.add_argument('shards', nargs='+', metavar='SHARD', help='Shard database files')
+    merge_parser.add_argument(
+        '-o', '--output',
+        required=True,
+        help='Merged database to create or update'
+    )
+
+    # Bench-hash command
+    bench_parser = subparsers.add_parser('bench-hash', help='Measure hashing throughput on this machine')
+    bench_parser.add_argument(
+        '--hash',
+        action='append',
+        choices=sorted(HASH_ALGORITHMS),
+        help='Algorithm to measure, may be repeated (default: all)'
+    )
+    bench_parser.add_argument(
+        '--size',
+        type=int,
+        default=256,
+        help='Size of the generated test data in MiB (default: 256)'
+    )
+    bench_parser.add_argument(
+        '--file',
+        help='Measure with an existing file (e.g. on the volume to be scanned) instead of generated data'
+    )
+
+    # Bench-scan command
+    bench_scan_parser = subparsers.add_parser('bench-scan', help='Time scans of generated trees')
+    bench_scan_parser.add_argument(
+        '--shape',
+        action='append',
+        choices=list(BENCH_SHAPES),
+        help='Tree shape, may be repeated (default: all)'
+    )
+    bench_scan_parser.add_argument(
+        '--scale',
+        type=float,
+        default=1.0,
+        help='Multiply the number of directories in each tree (default: 1)'
+    )
+    bench_scan_parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Number of parallel hashing threads (default: 1)'
+    )
+    bench_scan_parser.add_argument(
+        '--dir',
+        help='Generate trees here, e.g. on the volume to be scanned (default: the temporary directory)'
+    )
+    bench_scan_parser.add_argument(
+        '--metrics-json',
+        metavar='FILE',
+        help='Write every timing to FILE as JSON (- for stdout)'
+    )
 
     args = parser.parse_args()
 
@@ -287,22 +2383,149 @@ Examples:
         parser.print_help()
         return 1
 
-    df = DennisFile(args.db)
+    if args.command == 'bench-hash':
+        read_sizes = [64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+        bench_hash(args.hash or list(HASH_ALGORITHMS), read_sizes, args.size * 1024 * 1024, args.file)
+        return 0
+    if args.command == 'bench-scan':
+        results = bench_scan(args.shape or list(BENCH_SHAPES), args.scale, args.jobs, args.dir)
+        if args.metrics_json:
+            write_metrics(results, args.metrics_json)
+        return 0
+
+    try:
+        if args.command == 'scan':
+            df = DennisFile(args.db, args.hash, args.read_size * 1024, args.mmap, args.volume, args.chunks)
+        elif args.command == 'merge':
+            df = DennisFile(args.output)
+        else:
+            df = DennisFile(args.db)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
 
     try:
+        if getattr(args, 'attach', None):
+            df.attach_shards(args.attach)
         if args.command == 'scan':
-            df.scan_directory(args.path, update=args.update)
+            metrics = df.scan_directory(args.path, update=args.update, jobs=args.jobs, lazy=args.lazy,
+                                        quick=args.quick, resume=args.resume)
+            if metrics and args.metrics_json:
+                write_metrics(metrics, args.metrics_json)
         elif args.command == 'duplicates':
-            df.find_duplicates(min_size=args.min_size)
+            df.find_duplicates(min_size=args.min_size, output_format=args.format)
         elif args.command == 'usage':
-            df.show_usage(path_prefix=args.path)
+            df.show_usage(path_prefix=args.path, depth=args.depth)
         elif args.command == 'stats':
             df.show_stats()
+        elif args.command == 'dedup-estimate':
+            df.dedup_estimate(path_prefix=args.path, depth=args.depth)
+        elif args.command == 'merge':
+            df.merge_shards(args.shards)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        return 130
+    except BrokenPipeError:
+        # The reader (e.g. `head`) went away; stop quietly without a second error at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
     finally:
         df.close()
 
     return 0
 
 
+def load_tests(loader, tests, pattern):
+    """unittest's load_tests protocol for `python -m unittest dennisfile`
+
+    The test cases are defined in _test_cases() so that only test runs pay for
+    importing unittest.
+    """
+    for case in _test_cases():
+        tests.addTests(loader.loadTestsFromTestCase(case))
+    return tests
+
+
+def _test_cases():
+    import io
+    import tempfile
+    import unittest
+
+    # The files table as the first release created it: TEXT paths and hex SHA-256 hashes, user_version 0
+    BASELINE_SCHEMA = """
+        CREATE TABLE files (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            path TEXT NOT NULL UNIQUE,
+            size INTEGER NOT NULL,
+            hash TEXT NOT NULL,
+            mtime REAL NOT NULL,
+            scan_time TEXT NOT NULL
+        );
+        CREATE INDEX idx_hash ON files(hash);
+        CREATE INDEX idx_size ON files(size);
+    """
+
+    class MigrationTestCase(unittest.TestCase):
+        def setUp(self):
+            tmp = tempfile.TemporaryDirectory()
+            self.addCleanup(tmp.cleanup)
+            self.root = Path(tmp.name).resolve() / 'tree'
+            self.db_path = str(Path(tmp.name) / 'baseline.db')
+            contents = {'a.txt': b'same', 'sub/b.txt': b'same', 'c.txt': b'different'}
+            for name, data in contents.items():
+                path = self.root / name
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(data)
+
+            conn = sqlite3.connect(self.db_path)
+            conn.executescript(BASELINE_SCHEMA)
+            scan_time = datetime.now().isoformat()
+            for name, data in contents.items():
+                path = self.root / name
+                conn.execute("INSERT INTO files (path, size, hash, mtime, scan_time) VALUES (?, ?, ?, ?, ?)",
+                             (str(path), len(data), hashlib.sha256(data).hexdigest(), path.stat().st_mtime,
+                              scan_time))
+            conn.commit()
+            conn.close()
+
+        def quietly(self):
+            # Migrations and scans report progress; keep the test run's output clean
+            stack = contextlib.ExitStack()
+            stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+            stack.enter_context(contextlib.redirect_stderr(io.StringIO()))
+            return stack
+
+        def open(self):
+            with self.quietly():
+                df = DennisFile(self.db_path)
+            self.addCleanup(df.close)
+            return df
+
+        def test_migrates_to_current_version(self):
+            df = self.open()
+            self.assertEqual(df.conn.execute("PRAGMA user_version").fetchone()[0], SCHEMA_VERSION)
+            self.assertEqual(df.hash_algorithm, 'sha256')
+            self.assertEqual(df.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0], 3)
+
+        def test_keeps_duplicates(self):
+            df = self.open()
+            sets = list(df.duplicate_sets())
+            self.assertEqual(sets, [(hashlib.sha256(b'same').digest(), 4, 2,
+                                     [(str(self.root / 'a.txt'), False), (str(self.root / 'sub/b.txt'), False)])])
+
+        def test_rescan_keeps_hashes(self):
+            self.open().close()
+            df = self.open()
+            with self.quietly():
+                df.scan_directory(self.root, update=True)
+            hashes = {bytes(h) for h, in df.conn.execute("SELECT hash FROM files")}
+            self.assertEqual(hashes, {hashlib.sha256(b'same').digest(), hashlib.sha256(b'different').digest()})
+            self.assertEqual(len(list(df.duplicate_sets())), 1)
+
+    return [MigrationTestCase]
+
+
 if __name__ == '__main__':
     sys.exit(main())
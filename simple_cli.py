@@ -3,11 +3,10 @@
 
 # simple_cli: Copyright © 2025 Benjamin Holt - MIT License
 
-import re
+import os
 import sys
-from typing import Callable, Dict, List, Tuple
-import unittest
-from unittest.mock import Mock
+from collections.abc import Callable, Iterator
+# unittest, unittest.mock and typing are slow to import, so tests are only defined when they're run (see Tests)
 #####
 
 
@@ -33,6 +32,7 @@ def _main(*args, **opts):
     print(f"{opts = }")
     if opts.get("test", opts.get("t", False)):
         print("Running tests...")
+        import unittest
         unittest.main(argv=args)
     return 0
 #####
@@ -44,7 +44,7 @@ ExitCode = int | str | None  # sys.exit accepts these
 def run_main(
         main: Callable[..., ExitCode],
         usage: Callable[..., ExitCode] | None = None,
-        arg_list: List[str] | None = None,
+        arg_list: list[str] | None = None,
     ) -> ExitCode:
     """
     Parse command-line arguments and options with parse_args, then call a main function with the results; given a usage function, if -h or --help is set, call that instead.
@@ -53,14 +53,27 @@ def run_main(
     if usage and opts.get("help", opts.get("h", False)):
         return usage(*args, **opts)
     return main(*args, **opts)
+
+def run_main_iter(
+        main: Callable[..., ExitCode],
+        usage: Callable[..., ExitCode] | None = None,
+        arg_list: list[str] | None = None,
+    ) -> ExitCode:
+    """
+    Like run_main, but with parse_args_iter: main (or usage) is called with a single iterator of arguments, program name first, instead of *args, so @file arguments are only read as main consumes them.
+    """
+    args, opts = parse_args_iter(arg_list)
+    if usage and opts.get("help", opts.get("h", False)):
+        return usage(args, **opts)
+    return main(args, **opts)
 #####
 
 
 ###  Parse Args  ###
 OptionValue = bool | str
-ArgsOpts = Tuple[List[str], Dict[str, OptionValue]]
+ArgsOpts = tuple[list[str], dict[str, OptionValue]]
 
-def parse_args(arg_list: List[str] | None = None) -> ArgsOpts:
+def parse_args(arg_list: list[str] | None = None) -> ArgsOpts:
     """
     A simple parser that translates command-line arguments and options into a Python list and dict suitable for *args and **kwargs.
 
@@ -79,14 +92,61 @@ def parse_args(arg_list: List[str] | None = None) -> ArgsOpts:
     - Does not automatically map short options to long options; use a pattern like opts.get("foo", opts.get("f", False))
     - Does not support options with multiple values like --foo=bar,baz (though "bar,baz" would come through and could be split)
     """
+    args, options, _ = _parse(arg_list)
+    return (args, options)
+
+ARG_FILE_BLOCK_SIZE = 64 * 1024
+
+def parse_args_iter(arg_list: list[str] | None = None) -> tuple[Iterator[str], dict[str, OptionValue]]:
+    """
+    Generator form of parse_args for very long argument lists: options are parsed up front as usual, but arguments come back as an iterator, with any @file argument replaced by the arguments read from that file as the iterator reaches it.
+
+    - @path reads arguments from a file, @- from stdin
+    - Arguments are NUL-separated if there's a NUL in the first block read (e.g. from `find -print0`), otherwise newline-separated; empty ones are skipped
+    - Arguments read from files are never treated as options or further @files
+    - After the arguments separator (--), @path is an ordinary argument
+    """
+    args, options, args_only_from = _parse(arg_list)
+    return (_expand_arg_files(args, args_only_from), options)
+
+def _expand_arg_files(args: list[str], args_only_from: int) -> Iterator[str]:
+    for i, arg in enumerate(args):
+        if 0 < i < args_only_from and arg.startswith("@") and len(arg) > 1:
+            yield from read_arg_file(arg[1:])
+        else:
+            yield arg
+
+def read_arg_file(path: str) -> Iterator[str]:
+    """
+    Lazily read NUL- or newline-separated arguments from a file, or stdin for "-"; decoded like sys.argv, so any filename round-trips.
+    """
+    f = sys.stdin.buffer if path == "-" else open(path, "rb")
+    try:
+        sep = None
+        rest = b""
+        while block := f.read1(ARG_FILE_BLOCK_SIZE):  # read1 hands back piped input as it arrives
+            if sep is None:
+                sep = b"\0" if b"\0" in block else b"\n"
+            items = (rest + block).split(sep)
+            rest = items.pop()
+            yield from (os.fsdecode(item) for item in items if item)
+        if rest:
+            yield os.fsdecode(rest)
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+
+# Returns args, options, and the index in args where arguments after the separator (--) start
+def _parse(arg_list: list[str] | None) -> tuple[list[str], dict[str, OptionValue], int]:
     if arg_list is None:
         arg_list = sys.argv
     if not arg_list:
         raise ValueError("Argument list is empty; must include at least program name")
 
-    args: List[str] = [arg_list[0]]  # Start with program name
-    options: Dict[str, OptionValue] = {}
+    args: list[str] = [arg_list[0]]  # Start with program name
+    options: dict[str, OptionValue] = {}
     args_only = False
+    args_only_from = len(arg_list)  # Past the end if there's no separator
     for arg in arg_list[1:]:
         if args_only:
             args.append(arg)
@@ -96,8 +156,9 @@ def parse_args(arg_list: List[str] | None = None) -> ArgsOpts:
             ## Separator
             case "--":
                 args_only = True
+                args_only_from = len(args)
             ## Long options
-            case _ if re.match(r"--[^-]", arg):
+            case _ if arg[:2] == "--" and arg[2:3] not in ("", "-"):  # Plain string checks, no need to import re
                 arg = arg.lstrip("-")
                 v: OptionValue | None = None
                 if "=" in arg:
@@ -109,7 +170,7 @@ def parse_args(arg_list: List[str] | None = None) -> ArgsOpts:
                 k = k.replace("-", "_")
                 options[k] = v
             ## Short options
-            case _ if re.match(r"-[^-]", arg):
+            case _ if arg[:1] == "-" and arg[1:2] not in ("", "-"):
                 arg = arg.lstrip("-")
                 last_opt = None
                 if "=" in arg:
@@ -122,101 +183,162 @@ def parse_args(arg_list: List[str] | None = None) -> ArgsOpts:
             ## Anything else is an argument
             case _:
                 args.append(arg)
-    return (args, options)
+    return (args, options, args_only_from)
 #####
 
 
 ###  Tests  ###
-class RunMainTestCase(unittest.TestCase):
-    def test_usage(self):
-        main = Mock(return_value="main")
-        usage = Mock(return_value="usage")
-
-        r = run_main(main, usage, ("ProgName", "-h",))
-        main.assert_not_called()
-        usage.assert_called_once_with("ProgName", h=True)
-        self.assertEqual(r, "usage", "Should return usage return value")
-
-        main.reset_mock()
-        usage.reset_mock()
-
-        run_main(main, usage, ("ProgName", "--help",))
-        main.assert_not_called()
-        usage.assert_called_once_with("ProgName", help=True)
-
-        main.reset_mock()
-        usage.reset_mock()
-
-        r = run_main(main, None, ("ProgName", "-h",))
-        main.assert_called_once_with("ProgName", h=True)
-        usage.assert_not_called()
-        self.assertEqual(r, "main", "Should return main return value")
-
-class ParseArgsTestCase(unittest.TestCase):
-    def test_options(self):
-        args, opts = parse_args(("ProgName", "-f", "--bar=baz"))
-        self.assertEqual(args, ["ProgName"])
-        self.assertEqual(opts, {"f": True, "bar": "baz"})
-
-    def test_muli_word_options(self):
-        args, opts = parse_args(("ProgName", "--stuff-thing", "--foo-bar=baz",))
-        self.assertEqual(args, ["ProgName"])
-        self.assertEqual(opts, {"stuff_thing": True, "foo_bar": "baz"})
-
-    def test_args(self):
-        args, opts = parse_args(("ProgName", "arg1", "arg2"))
-        self.assertEqual(args, ["ProgName", "arg1", "arg2"])
-        self.assertEqual(opts, {})
-
-    def test_args_options(self):
-        args, opts = parse_args(("ProgName", "-f", "--bar=baz", "arg1", "arg2"))
-        self.assertEqual(args, ["ProgName", "arg1", "arg2"])
-        self.assertEqual(opts, {"f": True, "bar": "baz"})
-
-    def test_combined(self):
-        args, opts = parse_args(("ProgName", "-abc"))
-        self.assertEqual(args, ["ProgName"])
-        self.assertEqual(opts, {"a": True, "b": True, "c": True})
-
-    def test_negative(self):
-        args, opts = parse_args(("ProgName", "--no-foo"))
-        self.assertEqual(args, ["ProgName"])
-        self.assertEqual(opts, {"foo": False})
-
-    def test_value(self):
-        args, opts = parse_args(("ProgName", "--foo=bar"))
-        self.assertEqual(args, ["ProgName"])
-        self.assertEqual(opts, {"foo": "bar"})
-
-    def test_short_value(self):
-        args, opts = parse_args(("ProgName", "-f=bar"))
-        self.assertEqual(args, ["ProgName"])
-        self.assertEqual(opts, {"f": "bar"})
-
-    def test_short_combined_value(self):
-        args, opts = parse_args(("ProgName", "-abc=bar"))
-        self.assertEqual(args, ["ProgName"])
-        self.assertEqual(opts, {"a": True, "b": True, "c": "bar"})
-
-    def test_combined_short_last_wins(self):
-        args, opts = parse_args(("ProgName", "-cc=bar"))
-        self.assertEqual(args, ["ProgName"])
-        self.assertEqual(opts, {"c": "bar"})
-
-    def test_options_separator(self):
-        args, opts = parse_args(("ProgName", "-a", "--", "-f"))
-        self.assertEqual(args, ["ProgName", "-f"])
-        self.assertEqual(opts, {"a": True})
-
-    def test_weird_characters(self):
-        args, opts = parse_args(("ProgName", "-?", "-b*", "-a%=wut", "--bar$=baz?", "arg1?"))
-        self.assertEqual(args, ["ProgName", "arg1?"])
-        self.assertEqual(opts, {"?": True, "b":True, "*": True, "a": True, "%": "wut", "bar$":"baz?"})
-
-    def test_dash_value(self):
-        args, opts = parse_args(("ProgName", "-i=-", "--input=-", "--foo=-bar-",))
-        self.assertEqual(args, ["ProgName"])
-        self.assertEqual(opts, {"i": "-", "input": "-", "foo": "-bar-"})
+def load_tests(loader, tests, pattern):
+    """
+    unittest's load_tests protocol, used by both -t and `python -m unittest simple_cli`; the test cases are defined here so that only test runs pay for importing unittest.
+    """
+    for case in _test_cases():
+        tests.addTests(loader.loadTestsFromTestCase(case))
+    return tests
+
+def _test_cases():
+    import io
+    import tempfile
+    import unittest
+    from unittest.mock import Mock, patch
+
+    class RunMainTestCase(unittest.TestCase):
+        def test_usage(self):
+            main = Mock(return_value="main")
+            usage = Mock(return_value="usage")
+
+            r = run_main(main, usage, ("ProgName", "-h",))
+            main.assert_not_called()
+            usage.assert_called_once_with("ProgName", h=True)
+            self.assertEqual(r, "usage", "Should return usage return value")
+
+            main.reset_mock()
+            usage.reset_mock()
+
+            run_main(main, usage, ("ProgName", "--help",))
+            main.assert_not_called()
+            usage.assert_called_once_with("ProgName", help=True)
+
+            main.reset_mock()
+            usage.reset_mock()
+
+            r = run_main(main, None, ("ProgName", "-h",))
+            main.assert_called_once_with("ProgName", h=True)
+            usage.assert_not_called()
+            self.assertEqual(r, "main", "Should return main return value")
+
+    class ParseArgsTestCase(unittest.TestCase):
+        def test_options(self):
+            args, opts = parse_args(("ProgName", "-f", "--bar=baz"))
+            self.assertEqual(args, ["ProgName"])
+            self.assertEqual(opts, {"f": True, "bar": "baz"})
+
+        def test_muli_word_options(self):
+            args, opts = parse_args(("ProgName", "--stuff-thing", "--foo-bar=baz",))
+            self.assertEqual(args, ["ProgName"])
+            self.assertEqual(opts, {"stuff_thing": True, "foo_bar": "baz"})
+
+        def test_args(self):
+            args, opts = parse_args(("ProgName", "arg1", "arg2"))
+            self.assertEqual(args, ["ProgName", "arg1", "arg2"])
+            self.assertEqual(opts, {})
+
+        def test_args_options(self):
+            args, opts = parse_args(("ProgName", "-f", "--bar=baz", "arg1", "arg2"))
+            self.assertEqual(args, ["ProgName", "arg1", "arg2"])
+            self.assertEqual(opts, {"f": True, "bar": "baz"})
+
+        def test_combined(self):
+            args, opts = parse_args(("ProgName", "-abc"))
+            self.assertEqual(args, ["ProgName"])
+            self.assertEqual(opts, {"a": True, "b": True, "c": True})
+
+        def test_negative(self):
+            args, opts = parse_args(("ProgName", "--no-foo"))
+            self.assertEqual(args, ["ProgName"])
+            self.assertEqual(opts, {"foo": False})
+
+        def test_value(self):
+            args, opts = parse_args(("ProgName", "--foo=bar"))
+            self.assertEqual(args, ["ProgName"])
+            self.assertEqual(opts, {"foo": "bar"})
+
+        def test_short_value(self):
+            args, opts = parse_args(("ProgName", "-f=bar"))
+            self.assertEqual(args, ["ProgName"])
+            self.assertEqual(opts, {"f": "bar"})
+
+        def test_short_combined_value(self):
+            args, opts = parse_args(("ProgName", "-abc=bar"))
+            self.assertEqual(args, ["ProgName"])
+            self.assertEqual(opts, {"a": True, "b": True, "c": "bar"})
+
+        def test_combined_short_last_wins(self):
+            args, opts = parse_args(("ProgName", "-cc=bar"))
+            self.assertEqual(args, ["ProgName"])
+            self.assertEqual(opts, {"c": "bar"})
+
+        def test_options_separator(self):
+            args, opts = parse_args(("ProgName", "-a", "--", "-f"))
+            self.assertEqual(args, ["ProgName", "-f"])
+            self.assertEqual(opts, {"a": True})
+
+        def test_weird_characters(self):
+            args, opts = parse_args(("ProgName", "-?", "-b*", "-a%=wut", "--bar$=baz?", "arg1?"))
+            self.assertEqual(args, ["ProgName", "arg1?"])
+            self.assertEqual(opts, {"?": True, "b":True, "*": True, "a": True, "%": "wut", "bar$":"baz?"})
+
+        def test_dash_value(self):
+            args, opts = parse_args(("ProgName", "-i=-", "--input=-", "--foo=-bar-",))
+            self.assertEqual(args, ["ProgName"])
+            self.assertEqual(opts, {"i": "-", "input": "-", "foo": "-bar-"})
+
+    class ArgFilesTestCase(unittest.TestCase):
+        def arg_file(self, data):
+            f = tempfile.NamedTemporaryFile(delete=False)
+            self.addCleanup(os.remove, f.name)
+            with f:
+                f.write(data)
+            return f.name
+
+        def test_newline_separated(self):
+            path = self.arg_file(b"a b\nc\n\nd\n")
+            args, opts = parse_args_iter(("ProgName", "x", f"@{path}", "y"))
+            self.assertEqual(list(args), ["ProgName", "x", "a b", "c", "d", "y"])
+            self.assertEqual(opts, {})
+
+        def test_nul_separated(self):
+            path = self.arg_file(b"a\nb\0c\0")
+            args, _ = parse_args_iter(("ProgName", f"@{path}"))
+            self.assertEqual(list(args), ["ProgName", "a\nb", "c"])
+
+        def test_stdin(self):
+            stdin = io.TextIOWrapper(io.BytesIO(b"-f\n@other\n"))
+            with patch("sys.stdin", stdin):
+                args, opts = parse_args_iter(("ProgName", "@-", "-g"))
+                self.assertEqual(list(args), ["ProgName", "-f", "@other"])
+            self.assertEqual(opts, {"g": True})
+
+        def test_lazy(self):
+            args, opts = parse_args_iter(("ProgName", "--foo", "@/nonexistent/args", "--bar=baz"))
+            self.assertEqual(opts, {"foo": True, "bar": "baz"})
+            self.assertEqual(next(args), "ProgName")
+            with self.assertRaises(FileNotFoundError):
+                next(args)
+
+        def test_separator(self):
+            args, _ = parse_args_iter(("ProgName", "--", "@literal", "-f"))
+            self.assertEqual(list(args), ["ProgName", "@literal", "-f"])
+            self.assertEqual(parse_args(("ProgName", "@literal"))[0], ["ProgName", "@literal"])
+
+        def test_run_main_iter(self):
+            path = self.arg_file(b"a\nb\n")
+            main = Mock(side_effect=lambda args, **opts: list(args))
+            r = run_main_iter(main, None, ("ProgName", "-v", f"@{path}"))
+            self.assertEqual(r, ["ProgName", "a", "b"])
+            self.assertEqual(main.call_args.kwargs, {"v": True})
+
+    return (RunMainTestCase, ParseArgsTestCase, ArgFilesTestCase)
 #####
 
 